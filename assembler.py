@@ -2,8 +2,18 @@
 # Assembler for mini ARM processor
 # 2015-09-09 frederic.boulanger@centralesupelec.fr
 
-import pyparsing as pyp
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import mmap
+import os
+import re
+import shutil
+import struct
 import sys
+from array import array
 
 symbolicRegisters = {
 	'lr': ['r', '7'],
@@ -29,65 +39,608 @@ def expandPop(pstring, loc, toks):
 	return exp
 
 def hasStructure(arg):
-	return isinstance(arg, (list, tuple, pyp.ParseResults))
+	return isinstance(arg, (list, tuple))
 
 def isTag(arg):
 	return isinstance(arg, str) and (str.isalpha(arg[0]) or arg[0] == '_')
 
-# pyparsing grammar
-# hex value
-hexInteger = pyp.Group("0x"+pyp.Regex("[0-9A-F]+"))
-# signed integer
-integer = pyp.Regex("[+-]?[0-9]+")
-# Tags start with a letter or an underscore, and are then composed of letters, digits and underscores
-tag = pyp.Word(pyp.alphas+"_", pyp.alphanums+"_")
-# int value = signed integer, hex value or tag value
-intvalue = integer ^ hexInteger ^ tag
-# symbolic name of a register (sp is r6, lr is r7)
-symbolicreg = pyp.CaselessLiteral('sp') ^ pyp.CaselessLiteral('lr')
-symbolicreg.setParseAction(expandSymbolicReg)
+# Position of a line in the sources, for error messages and the listing
+# The origin of a line is (file name, line number, macro name), the file name being None
+# for the main source file, and the macro name None for lines which are not in a macro.
+# The column, when known, is counted from 1.
+def describeOrigin(origin, column=None):
+	fname, lineno, macro = origin
+	if fname is None:
+		where = 'line {}'.format(lineno) if column is None else 'line {}, column {}'.format(lineno, column)
+	else:
+		where = '{}:{}'.format(fname, lineno) if column is None else '{}:{}:{}'.format(fname, lineno, column)
+	if macro is not None:
+		where += ' (macro {})'.format(macro)
+	return where
+
+# Error or warning about a program, with its position in the sources if it is known
+class Diagnostic:
+	def __init__(self, severity, msg, origin=None, column=None):
+		# 'error' or 'warning'
+		self.severity = severity
+		self.msg = msg
+		self.origin = origin
+		self.column = column
+
+	def __str__(self):
+		if self.origin is None:
+			return self.msg
+		return describeOrigin(self.origin, self.column) + ': ' + self.msg
+
+	# Diagnostic as a dictionary for the JSON output, srcfname being the name of the main source file
+	def asDict(self, srcfname=None):
+		fname, lineno, macro = self.origin if self.origin else (None, None, None)
+		return {
+			'severity': self.severity,
+			'file': fname if fname is not None else srcfname,
+			'line': lineno,
+			'column': self.column,
+			'macro': macro,
+			'message': self.msg
+		}
+
+# Errors which prevent the assembly of a program
+# errors are messages or Diagnostic objects, the diagnostics attribute holds all of them
+# (with the warnings found before the errors) and the errors attribute their messages.
+class AsmError(Exception):
+	def __init__(self, *errors):
+		self.diagnostics = [e if isinstance(e, Diagnostic) else Diagnostic('error', e) for e in errors]
+		self.errors = tuple([str(d) for d in self.diagnostics if d.severity == 'error'])
+		Exception.__init__(self, '\n'.join(self.errors))
+
+# Syntax error in the source program
+class AsmSyntaxError(AsmError):
+	def __init__(self, lineno, msg, fname=None, macro=None, column=None):
+		AsmError.__init__(self, Diagnostic('error', msg, (fname, lineno, macro), column))
+		self.lineno = lineno
+		self.fname = fname
+
+def syntaxError(origin, msg, column=None):
+	return AsmSyntaxError(origin[1], msg, origin[0], origin[2], column)
+
+# Maximum number of errors reported for a program
+defaultMaxErrors = 100
+
+# Diagnostics collected while assembling a program, so that all its errors are reported
+# in a single run. The assembly stops with TooManyErrors after maxErrors errors.
+class Diagnostics:
+	def __init__(self, maxErrors=defaultMaxErrors):
+		self.items = []
+		self.errorCount = 0
+		self.maxErrors = maxErrors
+
+	def add(self, diagnostic):
+		self.items.append(diagnostic)
+		if diagnostic.severity == 'error':
+			self.errorCount += 1
+			if self.maxErrors and self.errorCount >= self.maxErrors:
+				raise TooManyErrors(*self.sorted())
+
+	def error(self, msg, origin=None, column=None):
+		self.add(Diagnostic('error', msg, origin, column))
+
+	def warning(self, msg, origin=None, column=None):
+		self.add(Diagnostic('warning', msg, origin, column))
+
+	# Diagnostics in the order of the sources: main file first, then included files
+	def sorted(self):
+		def position(diagnostic):
+			if diagnostic.origin is None:
+				return (2, '', 0, 0)
+			fname, lineno, macro = diagnostic.origin
+			return (fname is not None, fname or '', lineno, diagnostic.column or 0)
+		return sorted(self.items, key=position)
+
+	# Raise an AsmError with all the diagnostics if there are errors
+	def check(self):
+		if self.errorCount:
+			raise AsmError(*self.sorted())
+
+# Assembly stopped because of too many errors
+class TooManyErrors(AsmError):
+	def __init__(self, *errors):
+		AsmError.__init__(self, *(errors + ('too many errors, assembly stopped',)))
+
+# Line parser
+# Each source line is split once and its operands are parsed according to its
+# mnemonic. The result has the same structure as with the pyparsing grammar
+# below, converted to lists: [['@', tag], [mnemonic, arg1, ...]] or [[mnemonic, ...]]
+hexRe = re.compile(r'0x([0-9A-F]+)$')
+integerRe = re.compile(r'[+-]?[0-9]+$')
+tagRe = re.compile(r'[A-Za-z_][A-Za-z0-9_]*$')
+registerRe = re.compile(r'r([0-7])$')
+# Optional label, then optional mnemonic followed by its operands
+lineRe = re.compile(r'\s*(?:@\s*([A-Za-z_][A-Za-z0-9_]*))?\s*(?:([A-Za-z_][A-Za-z0-9_]*)(.*))?$')
+# Commas separate operands, except inside square brackets
+operandSepRe = re.compile(r',(?![^\[]*\])')
+
 # Registers are noted r0, r1, r2, r3, r4, r5, r6 and r7, or sp (stack pointer, r6) and lr (link register, r7)
-register = pyp.Group("r"+pyp.Regex("[0-7]").setName("regnum")) ^ symbolicreg
-# An immediate value is an int value prefixed by '#'
-immvalue = pyp.Group("#"+intvalue)
-# An argument may be a register or an immediate value
-argument = register ^ immvalue
-# An address may be given as an hex integer or as a symbolic tag
-address = tag ^ hexInteger
-# A branch address may be a register or an address
-braddress = register ^ address
+def parseRegister(text):
+	m = registerRe.match(text)
+	if m:
+		return ['r', m.group(1)]
+	if text.lower() in symbolicRegisters:
+		return sym2reg(text.lower())
+	return None
+
+# int value = signed integer, hex value or tag value
+def parseIntValue(text):
+	m = hexRe.match(text)
+	if m:
+		return ['0x', m.group(1)]
+	if integerRe.match(text) or tagRe.match(text):
+		return text
+	return None
+
+# An argument may be a register or an immediate value (an int value prefixed by '#')
+def parseArgument(text):
+	if text.startswith('#'):
+		value = parseIntValue(text[1:])
+		if value is None:
+			return None
+		return ['#', value]
+	return parseRegister(text)
+
+# A branch address may be a register or an address (an hex integer or a symbolic tag)
+def parseBrAddress(text):
+	reg = parseRegister(text)
+	if reg is not None:
+		return reg
+	m = hexRe.match(text)
+	if m:
+		return ['0x', m.group(1)]
+	if tagRe.match(text):
+		return text
+	return None
+
 # An indexed address can be an int value or a register and an optional int value between square brackets
-# With only an integer, this is direct addressing: ldr r0, 0x1234
-# With a register between square brackets, this is direct addressing by register= ldr r0, [r6]
-# Only the last case is real indexed addressing: ldr r0, [r6,1]
-indexedAddress = intvalue \
-               ^ pyp.Group(pyp.Suppress("[")+register+pyp.Suppress(",")+intvalue+pyp.Suppress("]")) \
-               ^ pyp.Group(pyp.Suppress("[")+register+pyp.Suppress("]"))
-instruction = (pyp.CaselessKeyword("ldr")+register+pyp.Suppress(",")+indexedAddress) \
-            ^ (pyp.CaselessKeyword("str")+register+pyp.Suppress(",")+indexedAddress) \
-            ^ (pyp.CaselessKeyword("mov")+register+pyp.Suppress(",")+argument) \
-            ^ (pyp.CaselessKeyword("add")+register+pyp.Suppress(",")+register+pyp.Suppress(",")+argument) \
-            ^ (pyp.CaselessKeyword("sub")+register+pyp.Suppress(",")+register+pyp.Suppress(",")+argument) \
-            ^ (pyp.CaselessKeyword("cmp")+register+pyp.Suppress(",")+argument) \
-            ^ (pyp.CaselessKeyword("blt")+braddress) \
-            ^ (pyp.CaselessKeyword("beq")+braddress) \
-            ^ (pyp.CaselessKeyword("b")+braddress) \
-            ^ (pyp.CaselessKeyword("bl")+register+pyp.Suppress(",")+braddress).setName('instruction')
-smwpseud = pyp.CaselessKeyword("smw")+intvalue
-rmwpseud = pyp.CaselessKeyword("rmw")+intvalue
-pushpseud = pyp.CaselessKeyword("push")+register
-pushpseud.setParseAction(expandPush)
-poppseud = pyp.CaselessKeyword("pop")+register
-poppseud.setParseAction(expandPop)
-pseudoinst = smwpseud \
-           ^ rmwpseud \
-           ^ pushpseud \
-           ^ poppseud
-label = pyp.Group("@"+tag)
-comment = pyp.Suppress("%")+pyp.Suppress(pyp.restOfLine(""))
-codeline = pyp.Group(pyp.Optional(label) + pyp.Group(instruction ^ pseudoinst) + pyp.Optional(comment))
-line = (comment ^ codeline)
-program = pyp.ZeroOrMore(line)
+def parseIndexedAddress(text):
+	if not text.startswith('['):
+		return parseIntValue(text)
+	if not text.endswith(']'):
+		return None
+	parts = text[1:-1].split(',')
+	reg = parseRegister(parts[0])
+	if reg is None or len(parts) > 2:
+		return None
+	if len(parts) == 1:
+		return [reg]
+	offset = parseIntValue(parts[1])
+	if offset is None:
+		return None
+	return [reg, offset]
+
+operandNames = {
+	parseRegister: 'register',
+	parseIntValue: 'integer or tag',
+	parseArgument: 'register or immediate value',
+	parseBrAddress: 'register or address',
+	parseIndexedAddress: 'address'
+}
+
+# Operands expected by each mnemonic
+operandKinds = {
+	'ldr' : (parseRegister, parseIndexedAddress),
+	'str' : (parseRegister, parseIndexedAddress),
+	'mov' : (parseRegister, parseArgument),
+	'add' : (parseRegister, parseRegister, parseArgument),
+	'sub' : (parseRegister, parseRegister, parseArgument),
+	'cmp' : (parseRegister, parseArgument),
+	'blt' : (parseBrAddress,),
+	'beq' : (parseBrAddress,),
+	'b'   : (parseBrAddress,),
+	'bl'  : (parseRegister, parseBrAddress),
+	'smw' : (parseIntValue,),
+	'rmw' : (parseIntValue,),
+	'push': (parseRegister,),
+	'pop' : (parseRegister,)
+}
+
+# Pseudo instructions which expand to several instructions
+pseudoExpansions = {
+	'push': expandPush,
+	'pop' : expandPop
+}
+
+# Columns of the operands of an instruction, column being that of the first character
+# of the operands (None if unknown)
+def operandColumns(operands, column):
+	if column is None:
+		return None
+	columns = []
+	for text in operandSepRe.split(operands):
+		columns.append(column + len(text) - len(text.lstrip()))
+		column += len(text) + 1
+	return columns
+
+# Parse an instruction, the mnemonic being already split from its operands
+# columns are those of the mnemonic and of the operands in the source line, for error messages
+def parseInstruction(mnemonic, operands, origin, column=None, opcolumn=None):
+	op = mnemonic.lower()
+	if op not in operandKinds:
+		raise syntaxError(origin, 'unsupported instruction ' + mnemonic, column)
+	kinds = operandKinds[op]
+	# Spaces are allowed anywhere between tokens
+	texts = operandSepRe.split(''.join(operands.split()))
+	if len(texts) != len(kinds):
+		raise syntaxError(origin, '{} expects {} operand(s)'.format(op, len(kinds)), column)
+	instr = [op]
+	for i, (kind, text) in enumerate(zip(kinds, texts)):
+		arg = kind(text)
+		if arg is None:
+			columns = operandColumns(operands, opcolumn)
+			raise syntaxError(origin, 'expected {}, found "{}"'.format(operandNames[kind], text),
+			                  columns[i] if columns else None)
+		instr.append(arg)
+	if op in pseudoExpansions:
+		return pseudoExpansions[op](None, 0, instr)
+	return instr
+
+# Parsed line, which knows its origin in the sources
+class SourceLine(list):
+	__slots__ = ('origin',)
+
+	def __init__(self, items, origin):
+		list.__init__(self, items)
+		self.origin = origin
+
+# Directives: .include "file.s", .macro name param1, param2..., .endm
+directiveRe = re.compile(r'\s*\.([A-Za-z]+)\s*(.*?)\s*$')
+includeRe = re.compile(r'"([^"]+)"$')
+macroRe = re.compile(r'([A-Za-z_][A-Za-z0-9_]*)\s*(.*)$')
+# Include directives of a source text, to find the files a program depends on
+includeLineRe = re.compile(r'^\s*\.include\s+"([^"]+)"', re.M)
+
+# Maximum depth of nested macro expansions
+maxMacroDepth = 100
+
+# Macro defined by .macro name param1, param2... and .endm
+# In the body, \param is replaced by the value of the parameter and \@ by the number of the
+# expansion (for labels which must be unique).
+class Macro:
+	def __init__(self, name, params, fname, lineno, scope):
+		self.name = name
+		self.params = params
+		# File and line of the definition
+		self.fname = fname
+		self.lineno = lineno
+		# Macros visible in the body (those of the file defining the macro)
+		self.scope = scope
+		# Lines of the body, as (line number, text) entries
+		self.body = []
+		# Parsed expansions by tuple of arguments, for macros which do not use \@
+		self.expansions = {}
+
+	def unique(self):
+		return any(['\\@' in text for lineno, text in self.body])
+
+	def substitute(self, args, count):
+		# Longest names first, so that \ab is not replaced as \a followed by b
+		params = sorted(zip(self.params, args), key=lambda p: -len(p[0]))
+		body = []
+		for lineno, text in self.body:
+			for param, arg in params:
+				text = text.replace('\\' + param, arg)
+			body.append((lineno, text.replace('\\@', str(count))))
+		return body
+
+# Parser of source programs with their .include and .macro directives
+# Included files are parsed only once as long as they are not modified, and the expansion of
+# a macro is parsed only once for the same arguments, so the parser can be used for all
+# the programs of a run.
+class SourceParser:
+	def __init__(self):
+		# Parsed included files by path, as (modification time, lines, macros) entries
+		self.files = {}
+		# Number of expansions of macros which use \@ in the program being parsed
+		self.expansionCount = 0
+		# Macros visible in the file being parsed
+		self.macros = {}
+		# Files and macros being parsed, to detect recursive inclusions and expansions
+		self.active = []
+		# Diagnostics of the program being parsed
+		self.diagnostics = Diagnostics()
+
+	# Parse a whole program, returns the list of code lines
+	# fname is the name of the source file, to find the included files (in the current
+	# directory if None). Syntax errors are added to diagnostics, the lines in error
+	# being left out. Without diagnostics, an AsmError is raised with all the errors.
+	def parse(self, text, fname=None, diagnostics=None):
+		self.start(fname, diagnostics)
+		lines = self.parseLines(enumerate(text.splitlines(), 1), None, self.dirname, None)
+		if diagnostics is None:
+			self.diagnostics.check()
+		return lines
+
+	# Parse a program given as an iterable of source lines (such as a file), yields its code lines
+	# as they are parsed. Syntax errors are added to diagnostics.
+	def parseStream(self, srclines, fname=None, diagnostics=None):
+		self.start(fname, diagnostics)
+		numbered = enumerate((line.rstrip('\r\n') for line in srclines), 1)
+		return self.readLines(numbered, None, self.dirname, None)
+
+	def start(self, fname, diagnostics):
+		# \@ is numbered from the start of each program, so that its labels do not depend on
+		# the programs parsed before
+		self.expansionCount = 0
+		self.macros = {}
+		self.active = []
+		self.dirname = os.path.dirname(fname) if fname else ''
+		self.diagnostics = diagnostics if diagnostics is not None else Diagnostics()
+
+	# Parse numbered lines of a file (None for the main file) or of the expansion of a macro
+	def parseLines(self, numbered, fname, dirname, macro):
+		return list(self.readLines(numbered, fname, dirname, macro))
+
+	# Generator of the code lines of numbered source lines
+	# A label alone on its line is attached to the next instruction
+	def readLines(self, numbered, fname, dirname, macro):
+		label = None
+		definition = None
+		lineno = 0
+		for lineno, srcline in numbered:
+			try:
+				comment = srcline.find('%')
+				if comment >= 0:
+					srcline = srcline[:comment]
+				origin = (fname, lineno, macro)
+				m = directiveRe.match(srcline)
+				if definition is not None:
+					if m and m.group(1).lower() == 'endm':
+						self.macros[definition.name] = definition
+						definition = None
+					elif m and m.group(1).lower() == 'macro':
+						raise syntaxError(origin, 'macro definitions cannot be nested')
+					else:
+						definition.body.append((lineno, srcline))
+					continue
+				if m:
+					directive = m.group(1).lower()
+					if directive == 'include':
+						included = self.parseInclude(m.group(2), origin, dirname)
+						if included:
+							yield from self.attach(label, included, origin)
+							label = None
+					elif directive == 'macro':
+						d = macroRe.match(m.group(2))
+						if d is None:
+							raise syntaxError(origin, 'expected a macro name')
+						params = [p.strip() for p in d.group(2).split(',')] if d.group(2).strip() else []
+						definition = Macro(d.group(1), params, fname, lineno, self.macros)
+					elif directive == 'endm':
+						raise syntaxError(origin, '.endm without .macro')
+					else:
+						raise syntaxError(origin, 'unknown directive .' + m.group(1))
+					continue
+				m = lineRe.match(srcline)
+				if m is None:
+					raise syntaxError(origin, 'syntax error')
+				tag, mnemonic, operands = m.groups()
+				if tag is not None:
+					if label is not None:
+						raise syntaxError(origin, 'several labels for the same instruction', m.start(1) + 1)
+					label = ['@', tag]
+				if mnemonic is None:
+					continue
+				if mnemonic in self.macros and mnemonic.lower() not in operandKinds:
+					expansion = self.expand(self.macros[mnemonic], operands, origin)
+					if expansion:
+						yield from self.attach(label, expansion, origin)
+						label = None
+					continue
+				instr = parseInstruction(mnemonic, operands, origin, m.start(2) + 1, m.start(3) + 1)
+				if label is not None:
+					yield SourceLine([label, instr], origin)
+					label = None
+				else:
+					yield SourceLine([instr], origin)
+			except AsmSyntaxError as e:
+				# The line is left out and the parsing goes on with the next one
+				self.diagnostics.add(e.diagnostics[0])
+		if definition is not None:
+			self.diagnostics.add(Diagnostic('error', 'macro ' + definition.name + ' has no .endm',
+			                                (fname, definition.lineno, macro)))
+		if label is not None:
+			self.diagnostics.add(Diagnostic('error', 'label @' + label[1] + ' is not followed by an instruction', origin))
+
+	# Included or expanded lines, the pending label being attached to the first one
+	def attach(self, label, sublines, origin):
+		if label is None:
+			yield from sublines
+			return
+		first = sublines[0]
+		if first[0][0] == '@':
+			raise syntaxError(origin, 'several labels for the same instruction')
+		yield SourceLine([label] + first, first.origin)
+		yield from sublines[1:]
+
+	# Lines of an included file, parsed only if it was modified since it was last parsed
+	# The macros defined by the file become visible in the including file. Files with errors
+	# are not kept, so that their errors are reported for each program including them.
+	def parseInclude(self, argument, origin, dirname):
+		m = includeRe.match(argument)
+		if m is None:
+			raise syntaxError(origin, 'expected a file name between double quotes')
+		path = os.path.join(dirname, m.group(1))
+		if path in self.active:
+			raise syntaxError(origin, 'recursive inclusion of ' + path)
+		try:
+			mtime = os.stat(path).st_mtime_ns
+			cached = self.files.get(os.path.abspath(path))
+			if cached is None or cached[0] != mtime:
+				with open(path) as srcfile:
+					text = srcfile.read()
+				saved = self.macros
+				self.macros = {}
+				self.active.append(path)
+				errors = self.diagnostics.errorCount
+				expansions = self.expansionCount
+				try:
+					lines = self.parseLines(enumerate(text.splitlines(), 1), path, os.path.dirname(path), None)
+				finally:
+					self.active.pop()
+					macros, self.macros = self.macros, saved
+				cached = (mtime, lines, macros)
+				# Files expanding macros which use \@ are numbered for this program only
+				if self.diagnostics.errorCount == errors and self.expansionCount == expansions:
+					self.files[os.path.abspath(path)] = cached
+		except (OSError, UnicodeDecodeError) as e:
+			raise syntaxError(origin, 'cannot include ' + path + ', ' + str(e))
+		self.macros.update(cached[2])
+		return cached[1]
+
+	# Lines of the expansion of a macro, for the operands of its invocation
+	def expand(self, macro, operands, origin):
+		args = tuple(operandSepRe.split(''.join(operands.split()))) if operands.strip() else ()
+		if len(args) != len(macro.params):
+			raise syntaxError(origin, 'macro {} expects {} argument(s)'.format(macro.name, len(macro.params)))
+		unique = macro.unique()
+		if not unique and args in macro.expansions:
+			return macro.expansions[args]
+		if len(self.active) >= maxMacroDepth:
+			raise syntaxError(origin, 'too many nested macro expansions')
+		self.expansionCount += 1
+		saved = self.macros
+		self.macros = macro.scope
+		self.active.append(macro.name)
+		errors = self.diagnostics.errorCount
+		try:
+			dirname = os.path.dirname(macro.fname) if macro.fname else self.dirname
+			lines = self.parseLines(macro.substitute(args, self.expansionCount), macro.fname, dirname, macro.name)
+		finally:
+			self.active.pop()
+			self.macros = saved
+		if not unique and self.diagnostics.errorCount == errors:
+			macro.expansions[args] = lines
+		return lines
+
+# Parse a whole program without its file name, returns the list of code lines
+def parseSource(text):
+	return SourceParser().parse(text)
+
+# Included files of a source text (recursively), as (path, text) entries
+def includedSources(text, dirname, seen=None):
+	if seen is None:
+		seen = set()
+	sources = []
+	for name in includeLineRe.findall(text):
+		path = os.path.join(dirname, name)
+		if path in seen:
+			continue
+		seen.add(path)
+		try:
+			with open(path) as srcfile:
+				included = srcfile.read()
+		except (OSError, UnicodeDecodeError):
+			continue
+		sources.append((path, included))
+		sources.extend(includedSources(included, os.path.dirname(path), seen))
+	return sources
+
+# pyparsing grammar, kept as a reference for the line parser
+# It is only built when needed since pyparsing is an optional dependency
+grammar = None
+
+def buildGrammar():
+	import pyparsing as pyp
+	# hex value
+	hexInteger = pyp.Group("0x"+pyp.Regex("[0-9A-F]+"))
+	# signed integer
+	integer = pyp.Regex("[+-]?[0-9]+")
+	# Tags start with a letter or an underscore, and are then composed of letters, digits and underscores
+	tag = pyp.Word(pyp.alphas+"_", pyp.alphanums+"_")
+	# int value = signed integer, hex value or tag value
+	intvalue = integer ^ hexInteger ^ tag
+	# symbolic name of a register (sp is r6, lr is r7)
+	symbolicreg = pyp.CaselessLiteral('sp') ^ pyp.CaselessLiteral('lr')
+	symbolicreg.setParseAction(expandSymbolicReg)
+	# Registers are noted r0, r1, r2, r3, r4, r5, r6 and r7, or sp (stack pointer, r6) and lr (link register, r7)
+	register = pyp.Group("r"+pyp.Regex("[0-7]").setName("regnum")) ^ symbolicreg
+	# An immediate value is an int value prefixed by '#'
+	immvalue = pyp.Group("#"+intvalue)
+	# An argument may be a register or an immediate value
+	argument = register ^ immvalue
+	# An address may be given as an hex integer or as a symbolic tag
+	address = tag ^ hexInteger
+	# A branch address may be a register or an address
+	braddress = register ^ address
+	# An indexed address can be an int value or a register and an optional int value between square brackets
+	# With only an integer, this is direct addressing: ldr r0, 0x1234
+	# With a register between square brackets, this is direct addressing by register= ldr r0, [r6]
+	# Only the last case is real indexed addressing: ldr r0, [r6,1]
+	indexedAddress = intvalue \
+	               ^ pyp.Group(pyp.Suppress("[")+register+pyp.Suppress(",")+intvalue+pyp.Suppress("]")) \
+	               ^ pyp.Group(pyp.Suppress("[")+register+pyp.Suppress("]"))
+	instruction = (pyp.CaselessKeyword("ldr")+register+pyp.Suppress(",")+indexedAddress) \
+	            ^ (pyp.CaselessKeyword("str")+register+pyp.Suppress(",")+indexedAddress) \
+	            ^ (pyp.CaselessKeyword("mov")+register+pyp.Suppress(",")+argument) \
+	            ^ (pyp.CaselessKeyword("add")+register+pyp.Suppress(",")+register+pyp.Suppress(",")+argument) \
+	            ^ (pyp.CaselessKeyword("sub")+register+pyp.Suppress(",")+register+pyp.Suppress(",")+argument) \
+	            ^ (pyp.CaselessKeyword("cmp")+register+pyp.Suppress(",")+argument) \
+	            ^ (pyp.CaselessKeyword("blt")+braddress) \
+	            ^ (pyp.CaselessKeyword("beq")+braddress) \
+	            ^ (pyp.CaselessKeyword("b")+braddress) \
+	            ^ (pyp.CaselessKeyword("bl")+register+pyp.Suppress(",")+braddress).setName('instruction')
+	smwpseud = pyp.CaselessKeyword("smw")+intvalue
+	rmwpseud = pyp.CaselessKeyword("rmw")+intvalue
+	pushpseud = pyp.CaselessKeyword("push")+register
+	pushpseud.setParseAction(expandPush)
+	poppseud = pyp.CaselessKeyword("pop")+register
+	poppseud.setParseAction(expandPop)
+	pseudoinst = smwpseud \
+	           ^ rmwpseud \
+	           ^ pushpseud \
+	           ^ poppseud
+	label = pyp.Group("@"+tag)
+	comment = pyp.Suppress("%")+pyp.Suppress(pyp.restOfLine(""))
+	codeline = pyp.Group(pyp.Optional(label) + pyp.Group(instruction ^ pseudoinst) + pyp.Optional(comment))
+	line = (comment ^ codeline)
+	return pyp.ZeroOrMore(line)
+
+# Convert nested parse results (also found inside pseudo instruction expansions) to lists
+def toList(res):
+	if isinstance(res, str):
+		return res
+	return [toList(r) for r in res]
+
+# Parse a whole program with the pyparsing grammar
+def parseSourcePyparsing(text):
+	global grammar
+	
+	if grammar is None:
+		grammar = buildGrammar()
+	import pyparsing as pyp
+	try:
+		return toList(grammar.parseString(text, parseAll=True))
+	except pyp.ParseBaseException as e:
+		# The grammar stops at the first error
+		raise AsmSyntaxError(e.lineno, e.msg, column=e.col)
+
+# Check that the line parser and the pyparsing grammar agree on some source files
+def checkParser(fnames):
+	ok = True
+	for fname in fnames:
+		with open(fname) as srcfile:
+			text = srcfile.read()
+		try:
+			lines = parseSource(text)
+		except AsmSyntaxError:
+			lines = None
+		try:
+			ref = parseSourcePyparsing(text)
+		except AsmSyntaxError:
+			ref = None
+		if lines == ref:
+			print('# ' + fname + ': OK')
+		else:
+			print('# ' + fname + ': line parser and pyparsing grammar differ')
+			ok = False
+	return ok
 
 
 # opcodes for the instructions
@@ -113,234 +666,6 @@ fieldshifts = {
 	'rz': 2			# rz register number is bits 4-2
 }
 
-# Map from labels to addresses
-labels = {}
-# Current program counter
-pc = 0
-
-# During first pas, do not check labels
-firstPass = True
-
-# Get an integer value from an intvalue ParseResult
-def getIntValue(value):
-	if hasStructure(value):  # ParseResult ['0x', hexvalue], unsigned hex value
-		val = int(value[1], 16)
-		if val >= (1 << 16):
-			print('# Error: value ' + value[1] + ' does not fit into 16 bits')
-		return val % (1 << 16)
-	elif isTag(value):       # tag
-		return getLabelValue(value)
-	else:				     # simple decimal value (signed)
-		val = int(value)
-		if (val < -(1 << 15)) or (val >= (1 << 15)):
-			print('# Error: signed value ' + value[1] + ' does not fit into 16 bits')
-		return int(value)
-
-def getAddressValue(address):
-	if isTag(address): # tag
-		return getLabelValue(address)
-	else:
-		return getIntValue(address)
-
-def getLabelValue(label):
-	if firstPass:
-		return 0
-	elif label in labels:
-		return labels[label]
-	else:
-		print('# Error: unknown label ' + label)
-		sys.exit(1)
-
-# Generate opcode for ldr instructions
-def generateLDR(instr):
-	global pc
-	
-	rx = instr[1]
-	adr = instr[2]
-	if hasStructure(adr) and adr[0] != '0x': # register or register + offset
-		if len(adr) == 2:   # register + offset (not supported in current processor)
-			offset = getIntValue(adr[1])
-			ry = adr[0]
-			mode = 1
-		else:               # register only
-			offset = 0
-			ry = adr[0]
-			mode = 0
-	else:               # address
-		offset = getIntValue(adr)
-		ry = ['r', '0']
-		mode = 1
-	code = (opcodes[instr[0]] << fieldshifts['opcode']) \
-	     | (mode << fieldshifts['mode']) \
-	     | (int(rx[1]) << fieldshifts['rx']) \
-	     | (int(ry[1]) << fieldshifts['ry'])
-	if mode == 0:
-		pc += 1
-		return "{:04X}".format(code)
-	else:
-		pc += 2
-		return ("{:04X}".format(code), "{:04X}".format(offset&0xFFFF))
-
-# Generate opcode for str instructions
-def generateSTR(instr):
-	global pc
-	
-	rz = instr[1]
-	adr = instr[2]
-	if hasStructure(adr) and adr[0] != '0x': # register or register + offset
-		if len(adr) == 2:   # register + offset (not supported in current processor)
-			offset = getIntValue(adr[1])
-			ry = adr[0]
-			mode = 1
-		else:               # register only
-			offset = 0
-			ry = adr[0]
-			mode = 0
-	else:               # address
-		offset = getIntValue(adr)
-		ry = ['r', '0']
-		mode = 1
-	code = (opcodes[instr[0]] << fieldshifts['opcode']) \
-	     | (mode << fieldshifts['mode']) \
-	     | (int(ry[1]) << fieldshifts['ry']) \
-	     | (int(rz[1]) << fieldshifts['rz'])
-	if mode == 0:
-		pc += 1
-		return "{:04X}".format(code)
-	else:
-		pc += 2
-		return ("{:04X}".format(code), "{:04X}".format(offset&0xFFFF))
-
-# Generate opcode for mov instructions
-def generateMOV(instr):
-	global pc
-	
-	rx = instr[1]
-	src = instr[2]
-	if hasStructure(src) and (src[0] == 'r'):  # register
-		code = (opcodes['mov'] << fieldshifts['opcode']) \
-			 | (0 << fieldshifts['mode']) \
-			 | (int(rx[1]) << fieldshifts['rx']) \
-			 | (int(src[1]) << fieldshifts['ry'])
-		pc += 1
-		return ("{:04X}".format(code))
-	else:                                      # immediate value
-		val = getIntValue(src[1])
-		code = (opcodes['mov'] << fieldshifts['opcode']) \
-			 | (1 << fieldshifts['mode']) \
-			 | (int(rx[1]) << fieldshifts['rx'])
-		pc += 2
-		return ("{:04X}".format(code), "{:04X}".format(val&0xFFFF))
-
-# Generate opcode for cmp instructions
-def generateCMP(instr):
-	global pc
-	
-	ry = instr[1]
-	src = instr[2]
-	if hasStructure(src) and (src[0] == 'r'):  # register
-		code = (opcodes['cmp'] << fieldshifts['opcode']) \
-			 | (0 << fieldshifts['mode']) \
-			 | (int(ry[1]) << fieldshifts['ry']) \
-			 | (int(src[1]) << fieldshifts['rz'])
-		pc += 1
-		return ("{:04X}".format(code))
-	else:                                      # immediate value
-		val = getIntValue(src[1])
-		if val < 0:
-			val = (1 << 16) - val
-		code = (opcodes['cmp'] << fieldshifts['opcode']) \
-			 | (1 << fieldshifts['mode']) \
-			 | (int(ry[1]) << fieldshifts['ry'])
-		pc += 2
-		return ("{:04X}".format(code), "{:04X}".format(val))
-
-# Generate opcode for add, sub, or, and instructions
-def generateARITH(instr):
-	global pc
-	
-	rx = instr[1]
-	ry = instr[2]
-	src = instr[3]
-	if hasStructure(src) and (src[0] == 'r'):  # register
-		code = (opcodes[instr[0]] << fieldshifts['opcode']) \
-			 | (0 << fieldshifts['mode']) \
-			 | (int(rx[1]) << fieldshifts['rx']) \
-			 | (int(src[1]) << fieldshifts['rz']) \
-			 | (int(ry[1]) << fieldshifts['ry'])
-		pc += 1
-		return ("{:04X}".format(code))
-	else:                                      # immediate value
-		val = getIntValue(src[1])
-		if val < 0:
-			val = (1 << 16) - val
-		code = (opcodes[instr[0]] << fieldshifts['opcode']) \
-			 | (1 << fieldshifts['mode']) \
-			 | (int(rx[1]) << fieldshifts['rx']) \
-			 | (int(ry[1]) << fieldshifts['ry'])
-		pc += 2
-		return ("{:04X}".format(code), "{:04X}".format(val))
-
-# Generate opcode for beq, blt and b instructions
-def generateBRANCH(instr):
-	global pc
-	
-	if hasStructure(instr[1]) and (instr[1][0] == 'r'): # branch to register
-		rz = instr[1]
-		code = (opcodes[instr[0]] << fieldshifts['opcode']) \
-		     | (0 << fieldshifts['mode']) \
-		     | (int(rz[1]) << fieldshifts['rz'])
-		pc += 1
-		return "{:04X}".format(code)
-	else:
-		baddr = getAddressValue(instr[1])
-		code = (opcodes[instr[0]] << fieldshifts['opcode']) \
-			 | (1 << fieldshifts['mode'])
-		pc += 2
-		return ("{:04X}".format(code), "{:04X}".format(baddr))
-
-# Generate opcode for the bl instruction
-def generateBRANCHLINK(instr):
-	global pc
-	
-	rx = instr[1]
-	if hasStructure(instr[2]) and (instr[2][0] == 'r'): # branch to register
-		rz = instr[1]
-		code = (opcodes[instr[0]] << fieldshifts['opcode']) \
-		     | (0 << fieldshifts['mode']) \
-		     | (int(rx[1]) << fieldshifts['rx']) \
-		     | (int(rz[1]) << fieldshifts['rz'])
-		pc += 1
-		return "{:04X}".format(code)
-	else:
-		baddr = getAddressValue(instr[2])
-		code = (opcodes[instr[0]] << fieldshifts['opcode']) \
-			 | (1 << fieldshifts['mode']) \
-		     | (int(rx[1]) << fieldshifts['rx'])
-		pc += 2
-		return ("{:04X}".format(code), "{:04X}".format(baddr))
-
-# Generate code for Set Memory Word pseudo instruction
-def generateSMW(instr):
-	global pc
-	
-	value = getIntValue(instr[1])
-	pc += 1
-	if value < 0 :
-		return ("{:04X}".format((1<<16) - value))
-	else:
-		return ("{:04X}".format(value))
-
-# Generate code for Reserve Memory Words pseudo instruction
-def generateRMW(instr):
-	global pc
-	
-	value = getIntValue(instr[1])
-	if (value < 0):
-		print('# Error: cannot reserve a negative ' + str(value) + ' number of memory words')
-	pc += value
-	return ('RMW', value)
-
 # Print an instruction argument in the listing
 def printarg(arg):
 	if hasStructure(arg):
@@ -360,7 +685,7 @@ def printarg(arg):
 	return str(arg)
 
 # Print an instruction line in the listing
-def printline(line):
+def printline(line, maxlabellen):
 	out = ''
 	idx = 0
 	if line[0][0] == '@':
@@ -377,116 +702,909 @@ def printline(line):
 		out += printarg(line[idx][i])
 	return out
 
-# Parse the source file
-p = program.parseFile(sys.argv[1], parseAll=True)
-
-# Compute the name of the output files (.mem and .lst)
-dotpos = sys.argv[1].rfind('.')
-if dotpos == -1:
-	binfname = sys.argv[1] + '.mem'
-	lstfname = sys.argv[1] + '.lst'
-else:
-	binfname = sys.argv[1][0:dotpos] + '.mem'
-	lstfname = sys.argv[1][0:dotpos] + '.lst'
-binfile = open(binfname, 'w')
-binfile.write('v2.0 raw')
-lstfile = open(lstfname, 'w')
-
-def makeBinSeparator(pc, binfile):
-	if (pc % 8) == 0:
-		binfile.write('\n')
-	else:
-		binfile.write(' ')
-
-def performOutput(line, bcode, pc):
-	if hasStructure(bcode): # two word instruction
-		if (bcode[0] == 'RMW'):
-			for i in range(bcode[1]):
-				makeBinSeparator(pc+i, binfile)
-				binfile.write("0000")
-			lstfile.write("{:04X} 0000 {}\n".format(pc, printline(line)))
+# Format of a full line of the memory image
+memRowFormat = ' '.join(['{:04X}'] * 8)
+zeroRow = array('H', bytes(16))
+
+# Memory image in Logisim 'v2.0 raw' format, 8 words per line
+def makeMem(words):
+	return 'v2.0 raw' + memRows(words)
+
+# Lines of a memory image, each one preceded by a newline
+def memRows(words):
+	out = []
+	full = len(words) - len(words) % 8
+	zeroLine = '\n' + memRowFormat.format(*zeroRow)
+	for i in range(0, full, 8):
+		row = words[i:i+8]
+		if row == zeroRow:
+			out.append(zeroLine)
 		else:
-			makeBinSeparator(pc, binfile)
-			binfile.write(bcode[0])
-			lstfile.write("{:04X} {} {}\n".format(pc, bcode[0], printline(line)))
-			makeBinSeparator(pc+1, binfile)
-			binfile.write(bcode[1])
-			lstfile.write("     {}\n".format(bcode[1]))
-	else:                   # single word instruction
-		makeBinSeparator(pc, binfile)
-		binfile.write(bcode)
-		lstfile.write("{:04X} {} {}\n".format(pc, bcode, printline(line)))
-
-def dispatchInstr(line):
-	global firstPass, pc
-	
-	instrpc = pc
-	idx = 0
-	if line[0][0] == '@':
-		idx += 1
-	op = line[idx][0]
-	if op == 'ldr':
-		bcode = generateLDR(line[idx])
-	elif op == 'str':
-		bcode = generateSTR(line[idx])
-	elif op == 'mov':
-		bcode = generateMOV(line[idx])
-	elif op == 'add':
-		bcode = generateARITH(line[idx])
-	elif op == 'sub':
-		bcode = generateARITH(line[idx])
-	elif op == 'cmp':
-		bcode = generateCMP(line[idx])
-	elif op == 'blt':
-		bcode = generateBRANCH(line[idx])
-	elif op == 'beq':
-		bcode = generateBRANCH(line[idx])
-	elif op == 'b':
-		bcode = generateBRANCH(line[idx])
-	elif op == 'bl':
-		bcode = generateBRANCHLINK(line[idx])
-	elif op == 'smw':
-		bcode = generateSMW(line[idx])
-	elif op == 'rmw':
-		bcode = generateRMW(line[idx])
-	elif hasStructure(op):   # pseudo instruction expansion
-		firstInstr = True
-		for sub in line[idx]:
-			# Attach label of pseudo instruction to first instruction in expansion
-			if firstInstr and idx > 0:
-				firstInstr = False
-				dispatchInstr([line[0], sub])
+			out.append('\n' + memRowFormat.format(*row))
+	if full < len(words):
+		out.append('\n' + ' '.join(['{:04X}'.format(w) for w in words[full:]]))
+	return ''.join(out)
+
+# Output formats of the memory image, with the extension of their files:
+#  - logisim: Logisim 'v2.0 raw' text, 8 words per line
+#  - bin-le, bin-be: raw binary, each word in little or big endian byte order
+#  - ihex: Intel HEX, with byte addresses and words in little endian byte order
+outputFormats = {
+	'logisim': '.mem',
+	'bin-le': '.bin',
+	'bin-be': '.bin',
+	'ihex': '.hex'
+}
+
+# Reserved regions of at least this number of words are left as holes in binary files
+# (and are not written in Intel HEX files)
+sparseWords = 2048
+
+# Intel HEX record
+def ihexRecord(address, rtype, data):
+	record = bytes([len(data), address >> 8, address & 0xFF, rtype]) + bytes(data)
+	return ':' + record.hex().upper() + '{:02X}'.format(-sum(record) & 0xFF)
+
+# Source maps (.map files) are little endian binary files made of:
+#  - a header: sourceMapMagic, number of words and number of files (32 bits each)
+#  - a flat array of 8 byte records indexed by address, one for each word of the memory image:
+#    source line (32 bits, 0 if unknown), index of the source file and number of words of the
+#    instruction (16 bits each, the number of words being 0 for the words after the first one)
+#  - the names of the files, as a 16 bit length followed by the UTF-8 name, the first one
+#    being the main source file
+# so that the line of any address is found at a fixed offset, without reading the whole file.
+sourceMapMagic = b'MAMAP01\0'
+
+# Result of the assembly of a program
+class Image:
+	def __init__(self, words, labels, code, origins=None, diagnostics=None):
+		# Memory image, indexed by address
+		self.words = words
+		# Map from labels to addresses
+		self.labels = labels
+		# Assembled lines, as (line, pc, number of words) entries
+		self.code = code
+		# Origin of each assembled line in the sources (see describeOrigin), None if unknown
+		self.origins = origins if origins is not None else [None] * len(code)
+		# Warnings found while assembling the program
+		self.diagnostics = diagnostics if diagnostics is not None else []
+		# Size and cycles before and after the optimization (see optimizer.optimizationReport),
+		# None if the program is not optimized
+		self.report = None
+
+	# Memory image in Logisim format (.mem file)
+	def mem(self):
+		return makeMem(self.words)
+
+	# Lines of the listing, as (pc, lines of the instruction) entries
+	def listingLines(self):
+		# Length of longest label (for formatting the listing)
+		maxlabellen = max([len(label) for label in self.labels], default=0)
+		out = []
+		for (line, instrpc, size), origin in zip(self.code, self.origins):
+			text = printline(line, maxlabellen)
+			# Lines of included files and macros are followed by their origin
+			if origin is not None and (origin[0] is not None or origin[2] is not None):
+				text += ' % ' + describeOrigin(origin)
+			if line[-1][0] == 'rmw':
+				out.append((instrpc, ["{:04X} 0000 {}".format(instrpc, text)]))
+			elif size == 2:
+				out.append((instrpc, ["{:04X} {:04X} {}".format(instrpc, self.words[instrpc], text),
+				                      "     {:04X}".format(self.words[instrpc+1])]))
 			else:
-				dispatchInstr([sub])
+				out.append((instrpc, ["{:04X} {:04X} {}".format(instrpc, self.words[instrpc], text)]))
+		return out
+
+	# Listing of the program, with the address and code of each line (.lst file)
+	def listing(self):
+		return ''.join([''.join([l + '\n' for l in lines]) for instrpc, lines in self.listingLines()])
+
+	# Symbol table (.sym file), an "address label" line for each label, sorted by address
+	def symbols(self):
+		entries = sorted([(address, label) for label, address in self.labels.items()])
+		return ''.join(['{:04X} {}\n'.format(address, label) for address, label in entries])
+
+	# Source map (.map file), with the source line of each word of the memory image, srcfname
+	# being the name of the main source file. See sourceMapMagic for the format.
+	def sourceMap(self, srcfname=None):
+		files = [srcfname or '']
+		index = {None: 0}
+		records = array('H', bytes(8 * len(self.words)))
+		for (line, instrpc, size), origin in zip(self.code, self.origins):
+			if origin is None or size == 0:
+				continue
+			fname, lineno, macro = origin
+			if fname not in index:
+				index[fname] = len(files)
+				files.append(fname)
+			start, end = 4 * instrpc, 4 * (instrpc + size)
+			records[start:end:4] = array('H', [lineno & 0xFFFF]) * size
+			records[start+1:end:4] = array('H', [lineno >> 16]) * size
+			records[start+2:end:4] = array('H', [index[fname]]) * size
+			records[start+3] = min(size, 0xFFFF)
+		if sys.byteorder != 'little':
+			records.byteswap()
+		names = [name.encode() for name in files]
+		return sourceMapMagic + struct.pack('<II', len(self.words), len(files)) + records.tobytes() \
+		     + b''.join([struct.pack('<H', len(name)) + name for name in names])
+
+	# Ranges of addresses to write in binary formats, as (start, end) entries
+	# Large reserved regions (rmw) are left out
+	def segments(self):
+		segments = []
+		start = 0
+		for line, instrpc, size in self.code:
+			if line[-1][0] == 'rmw' and size >= sparseWords:
+				if instrpc > start:
+					segments.append((start, instrpc))
+				start = instrpc + size
+		if len(self.words) > start:
+			segments.append((start, len(self.words)))
+		return segments
+
+	# Write the memory image in a raw binary file, byteorder being 'little' or 'big'
+	# The file is created with its final size and mapped in memory, so that the words are
+	# copied only once, and large reserved regions are holes in the file.
+	def writeBinary(self, fname, byteorder='little'):
+		size = 2 * len(self.words)
+		with open(fname, 'wb+') as binfile:
+			binfile.truncate(size)
+			if size == 0:
+				return
+			with mmap.mmap(binfile.fileno(), size) as mm:
+				for start, end in self.segments():
+					chunk = memoryview(self.words)[start:end]
+					if byteorder != sys.byteorder:
+						chunk = array('H', chunk)
+						chunk.byteswap()
+					mm[2*start:2*end] = memoryview(chunk).cast('B')
+
+	# Memory image in Intel HEX format (.hex file), 16 bytes per record
+	# Records which contain only zeros are left out.
+	def ihex(self):
+		words = self.words
+		if sys.byteorder != 'little':
+			words = array('H', words)
+			words.byteswap()
+		data = memoryview(words).cast('B')
+		out = []
+		upper = 0
+		for offset in range(0, len(data), 16):
+			chunk = data[offset:offset+16]
+			if not any(chunk):
+				continue
+			if offset >> 16 != upper:   # extended linear address
+				upper = offset >> 16
+				out.append(ihexRecord(0, 4, upper.to_bytes(2, 'big')))
+			out.append(ihexRecord(offset & 0xFFFF, 0, chunk))
+		out.append(ihexRecord(0, 1, b''))
+		return '\n'.join(out) + '\n'
+
+	# Write the memory image in one of the outputFormats
+	def write(self, fname, fmt='logisim'):
+		if fmt == 'bin-le' or fmt == 'bin-be':
+			self.writeBinary(fname, 'little' if fmt == 'bin-le' else 'big')
+			return
+		with open(fname, 'w') as binfile:
+			binfile.write(self.mem() if fmt == 'logisim' else self.ihex())
+
+# Assembler for the mini ARM
+# An assembler may be used for several programs, its state is reset for each of them.
+class Assembler:
+	def __init__(self, pyparsing=False, optimize=0, maxErrors=defaultMaxErrors):
+		# Use the reference pyparsing grammar instead of the line parser
+		# (which is needed for the .include and .macro directives)
+		self.pyparsing = pyparsing
+		# Line parser, which keeps included files and macro expansions from one program to the next
+		self.sourceParser = SourceParser()
+		# Optimization level of the parsed program (see optimizer.py), 0 for none
+		self.optimize = optimize
+		# Errors and warnings of the program, from its parsing to its linking
+		self.maxErrors = maxErrors
+		self.diagnostics = Diagnostics(maxErrors)
+		self.reset()
+
+	def reset(self):
+		# Map from labels to addresses
+		self.labels = {}
+		# Current program counter
+		self.pc = 0
+		# Memory image, indexed by address
+		self.image = array('H')
+		# Assembled lines, as (line, pc, number of words) entries
+		self.code = []
+		# Origin in the sources of each assembled line, and of the line being assembled
+		self.origins = []
+		self.origin = None
+		# Fixup table for references to labels which are not defined yet, as (address, label, origin) entries
+		self.fixups = []
+		# Undefined labels referenced by the instruction being assembled
+		self.pendingLabels = []
+
+	# Options which may change the output of the assembler, for the assembly cache
+	def signature(self):
+		return 'pyparsing={} optimize={}'.format(self.pyparsing, self.optimize)
+
+	# Parse a program, which starts the collection of its diagnostics
+	# The lines with syntax errors are left out, their errors are reported by link().
+	def parse(self, source, fname=None):
+		self.diagnostics = Diagnostics(self.maxErrors)
+		if self.pyparsing:
+			try:
+				lines = parseSourcePyparsing(source)
+			except AsmSyntaxError as e:
+				self.diagnostics.add(e.diagnostics[0])
+				lines = []
+		else:
+			lines = self.sourceParser.parse(source, fname, self.diagnostics)
+		if self.optimize and not self.diagnostics.errorCount:
+			import optimizer
+			lines = optimizer.optimize(lines, self.optimize)
+		return lines
+
+	# Assemble a program given as source text, returns its Image
+	# fname is the name of the source file, used to find its included files
+	# An optimized program is run in the simulator together with the original one, raises an
+	# AsmError if they do not give the same results and warns if they could not be compared.
+	def assemble(self, source, fname=None):
+		self.encode(self.parse(source, fname))
+		image = self.link()
+		if self.optimize:
+			import optimizer
+			before = Assembler(self.pyparsing, 0, self.maxErrors).assemble(source, fname)
+			image.report, unverified = optimizer.optimizationReport(before, image)
+			if unverified:
+				image.diagnostics.append(Diagnostic('warning', 'optimized program not verified, ' + unverified))
+		return image
+
+	# Assemble parsed lines in a single pass, labels are defined as they are met
+	# Errors are added to the diagnostics and the assembly goes on with the next line.
+	def encode(self, lines):
+		self.reset()
+		for line in lines:
+			self.origin = getattr(line, 'origin', None)
+			if line[0][0] == '@':
+				self.labels[line[0][1]] = self.pc
+			try:
+				self.dispatchInstr(line)
+			except TooManyErrors:
+				raise
+			except AsmError as e:
+				del self.pendingLabels[:]
+				self.addErrors(e)
+
+	# Add the errors of an AsmError to the diagnostics, at the line being assembled
+	def addErrors(self, error):
+		for diagnostic in error.diagnostics:
+			if diagnostic.origin is None:
+				diagnostic.origin = self.origin
+			self.diagnostics.add(diagnostic)
+
+	# Patch forward references once all the lines are encoded, returns the Image of the program
+	# Raises an AsmError with all the diagnostics of the program if there are errors.
+	def link(self):
+		for address, label, origin in self.resolveFixups():
+			self.diagnostics.add(Diagnostic('error', 'unknown label ' + label, origin))
+		self.diagnostics.check()
+		return Image(self.image, self.labels, self.code, self.origins, self.diagnostics.sorted())
+
+	# Get an integer value from an intvalue ParseResult
+	def getIntValue(self, value):
+		if hasStructure(value):  # ParseResult ['0x', hexvalue], unsigned hex value
+			val = int(value[1], 16)
+			if val >= (1 << 16):
+				self.diagnostics.error('value 0x' + value[1] + ' does not fit into 16 bits', self.origin)
+			return val % (1 << 16)
+		elif isTag(value):       # tag
+			return self.getLabelValue(value)
+		else:				     # simple decimal value (signed)
+			val = int(value)
+			if (val < -(1 << 15)) or (val >= (1 << 15)):
+				self.diagnostics.error('signed value ' + value + ' does not fit into 16 bits', self.origin)
+			return int(value)
+
+	def getAddressValue(self, address):
+		if isTag(address): # tag
+			return self.getLabelValue(address)
+		else:
+			return self.getIntValue(address)
+
+	# Forward references are assembled as 0 and patched once all labels are known
+	def getLabelValue(self, label):
+		if label in self.labels:
+			return self.labels[label]
+		self.pendingLabels.append(label)
+		return 0
+
+	# Generate opcode for ldr instructions
+	def generateLDR(self, instr):
+		rx = instr[1]
+		adr = instr[2]
+		if hasStructure(adr) and adr[0] != '0x': # register or register + offset
+			if len(adr) == 2:   # register + offset (not supported in current processor)
+				offset = self.getIntValue(adr[1])
+				ry = adr[0]
+				mode = 1
+			else:               # register only
+				offset = 0
+				ry = adr[0]
+				mode = 0
+		else:               # address
+			offset = self.getIntValue(adr)
+			ry = ['r', '0']
+			mode = 1
+		code = (opcodes[instr[0]] << fieldshifts['opcode']) \
+		     | (mode << fieldshifts['mode']) \
+		     | (int(rx[1]) << fieldshifts['rx']) \
+		     | (int(ry[1]) << fieldshifts['ry'])
+		if mode == 0:
+			self.pc += 1
+			return code
+		else:
+			self.pc += 2
+			return (code, offset & 0xFFFF)
+
+	# Generate opcode for str instructions
+	def generateSTR(self, instr):
+		rz = instr[1]
+		adr = instr[2]
+		if hasStructure(adr) and adr[0] != '0x': # register or register + offset
+			if len(adr) == 2:   # register + offset (not supported in current processor)
+				offset = self.getIntValue(adr[1])
+				ry = adr[0]
+				mode = 1
+			else:               # register only
+				offset = 0
+				ry = adr[0]
+				mode = 0
+		else:               # address
+			offset = self.getIntValue(adr)
+			ry = ['r', '0']
+			mode = 1
+		code = (opcodes[instr[0]] << fieldshifts['opcode']) \
+		     | (mode << fieldshifts['mode']) \
+		     | (int(ry[1]) << fieldshifts['ry']) \
+		     | (int(rz[1]) << fieldshifts['rz'])
+		if mode == 0:
+			self.pc += 1
+			return code
+		else:
+			self.pc += 2
+			return (code, offset & 0xFFFF)
+
+	# Generate opcode for mov instructions
+	def generateMOV(self, instr):
+		rx = instr[1]
+		src = instr[2]
+		if hasStructure(src) and (src[0] == 'r'):  # register
+			code = (opcodes['mov'] << fieldshifts['opcode']) \
+				 | (0 << fieldshifts['mode']) \
+				 | (int(rx[1]) << fieldshifts['rx']) \
+				 | (int(src[1]) << fieldshifts['ry'])
+			self.pc += 1
+			return code
+		else:                                      # immediate value
+			val = self.getIntValue(src[1])
+			code = (opcodes['mov'] << fieldshifts['opcode']) \
+				 | (1 << fieldshifts['mode']) \
+				 | (int(rx[1]) << fieldshifts['rx'])
+			self.pc += 2
+			return (code, val & 0xFFFF)
+
+	# Generate opcode for cmp instructions
+	def generateCMP(self, instr):
+		ry = instr[1]
+		src = instr[2]
+		if hasStructure(src) and (src[0] == 'r'):  # register
+			code = (opcodes['cmp'] << fieldshifts['opcode']) \
+				 | (0 << fieldshifts['mode']) \
+				 | (int(ry[1]) << fieldshifts['ry']) \
+				 | (int(src[1]) << fieldshifts['rz'])
+			self.pc += 1
+			return code
+		else:                                      # immediate value
+			val = self.getIntValue(src[1])
+			code = (opcodes['cmp'] << fieldshifts['opcode']) \
+				 | (1 << fieldshifts['mode']) \
+				 | (int(ry[1]) << fieldshifts['ry'])
+			self.pc += 2
+			return (code, val & 0xFFFF)
+
+	# Generate opcode for add, sub, or, and instructions
+	def generateARITH(self, instr):
+		rx = instr[1]
+		ry = instr[2]
+		src = instr[3]
+		if hasStructure(src) and (src[0] == 'r'):  # register
+			code = (opcodes[instr[0]] << fieldshifts['opcode']) \
+				 | (0 << fieldshifts['mode']) \
+				 | (int(rx[1]) << fieldshifts['rx']) \
+				 | (int(src[1]) << fieldshifts['rz']) \
+				 | (int(ry[1]) << fieldshifts['ry'])
+			self.pc += 1
+			return code
+		else:                                      # immediate value
+			val = self.getIntValue(src[1])
+			code = (opcodes[instr[0]] << fieldshifts['opcode']) \
+				 | (1 << fieldshifts['mode']) \
+				 | (int(rx[1]) << fieldshifts['rx']) \
+				 | (int(ry[1]) << fieldshifts['ry'])
+			self.pc += 2
+			return (code, val & 0xFFFF)
+
+	# Generate opcode for beq, blt and b instructions
+	def generateBRANCH(self, instr):
+		if hasStructure(instr[1]) and (instr[1][0] == 'r'): # branch to register
+			rz = instr[1]
+			code = (opcodes[instr[0]] << fieldshifts['opcode']) \
+			     | (0 << fieldshifts['mode']) \
+			     | (int(rz[1]) << fieldshifts['rz'])
+			self.pc += 1
+			return code
+		else:
+			baddr = self.getAddressValue(instr[1])
+			code = (opcodes[instr[0]] << fieldshifts['opcode']) \
+				 | (1 << fieldshifts['mode'])
+			self.pc += 2
+			return (code, baddr & 0xFFFF)
+
+	# Generate opcode for the bl instruction
+	def generateBRANCHLINK(self, instr):
+		rx = instr[1]
+		if hasStructure(instr[2]) and (instr[2][0] == 'r'): # branch to register
+			rz = instr[2]
+			code = (opcodes[instr[0]] << fieldshifts['opcode']) \
+			     | (0 << fieldshifts['mode']) \
+			     | (int(rx[1]) << fieldshifts['rx']) \
+			     | (int(rz[1]) << fieldshifts['rz'])
+			self.pc += 1
+			return code
+		else:
+			baddr = self.getAddressValue(instr[2])
+			code = (opcodes[instr[0]] << fieldshifts['opcode']) \
+				 | (1 << fieldshifts['mode']) \
+			     | (int(rx[1]) << fieldshifts['rx'])
+			self.pc += 2
+			return (code, baddr & 0xFFFF)
+
+	# Generate code for Set Memory Word pseudo instruction
+	def generateSMW(self, instr):
+		value = self.getIntValue(instr[1])
+		self.pc += 1
+		return value & 0xFFFF
+
+	# Generate code for Reserve Memory Words pseudo instruction
+	def generateRMW(self, instr):
+		if isTag(instr[1]) and instr[1] not in self.labels:
+			raise AsmError('label ' + instr[1] + ' must be defined before being used as a number of memory words')
+		value = self.getIntValue(instr[1])
+		if (value < 0):
+			raise AsmError('cannot reserve a negative ' + str(value) + ' number of memory words')
+		self.pc += value
+		return ('RMW', value)
+
+
+	def dispatchInstr(self, line):
+		instrpc = self.pc
+		idx = 0
+		if line[0][0] == '@':
+			idx += 1
+		op = line[idx][0]
+		if op == 'ldr':
+			bcode = self.generateLDR(line[idx])
+		elif op == 'str':
+			bcode = self.generateSTR(line[idx])
+		elif op == 'mov':
+			bcode = self.generateMOV(line[idx])
+		elif op == 'add':
+			bcode = self.generateARITH(line[idx])
+		elif op == 'sub':
+			bcode = self.generateARITH(line[idx])
+		elif op == 'cmp':
+			bcode = self.generateCMP(line[idx])
+		elif op == 'blt':
+			bcode = self.generateBRANCH(line[idx])
+		elif op == 'beq':
+			bcode = self.generateBRANCH(line[idx])
+		elif op == 'b':
+			bcode = self.generateBRANCH(line[idx])
+		elif op == 'bl':
+			bcode = self.generateBRANCHLINK(line[idx])
+		elif op == 'smw':
+			bcode = self.generateSMW(line[idx])
+		elif op == 'rmw':
+			bcode = self.generateRMW(line[idx])
+		elif hasStructure(op):   # pseudo instruction expansion
+			firstInstr = True
+			for sub in line[idx]:
+				# Attach label of pseudo instruction to first instruction in expansion
+				if firstInstr and idx > 0:
+					firstInstr = False
+					self.dispatchInstr([line[0], sub])
+				else:
+					self.dispatchInstr([sub])
+			return
+		else:
+			raise AsmError('unsupported instruction ' + str(line[idx][0]))
+		if not hasStructure(bcode):      # single word instruction
+			self.image.append(bcode)
+		elif bcode[0] == 'RMW':          # reserved words are left as zeros
+			self.image.frombytes(bytes(2 * bcode[1]))
+		else:                            # two word instruction
+			self.image.extend(bcode)
+		# The label value is always the last word of the instruction
+		for label in self.pendingLabels:
+			self.fixups.append((self.pc - 1, label, self.origin))
+		del self.pendingLabels[:]
+		self.code.append((line, instrpc, self.pc - instrpc))
+		self.origins.append(self.origin)
+
+	# Patch forward references, returns the fixups of undefined labels
+	def resolveFixups(self):
+		undefined = []
+		for fixup in self.fixups:
+			address, label, origin = fixup
+			if label in self.labels:
+				self.image[address] = self.labels[label] & 0xFFFF
+			else:
+				undefined.append(fixup)
+		return undefined
+
+# Assembler writing the memory image as the program is read, for very large programs
+# Words are written as soon as the labels they reference are defined: only the words from
+# the first unresolved forward reference on are kept, with the fixups of the labels which are
+# not defined yet. The listing and the optimizer need the whole program and are not available.
+class StreamAssembler(Assembler):
+	# Number of words kept before trying to write them
+	flushSize = 4096
+
+	def reset(self):
+		Assembler.reset(self)
+		# Address of the first word of self.image
+		self.base = 0
+		# References to each undefined label, as (address, origin) entries
+		self.waiting = {}
+
+	# Assemble a program given as an iterable of source lines, and write its memory image
+	# to the out file in Logisim format
+	# Raises an AsmError with all the diagnostics if there are errors (the output is then incomplete),
+	# returns the warnings otherwise.
+	def assembleStream(self, srclines, out, fname=None):
+		self.reset()
+		self.diagnostics = Diagnostics(self.maxErrors)
+		out.write('v2.0 raw')
+		for line in self.sourceParser.parseStream(srclines, fname, self.diagnostics):
+			self.origin = line.origin
+			if line[0][0] == '@':
+				self.defineLabel(line[0][1])
+			try:
+				self.dispatchInstr(line)
+			except TooManyErrors:
+				raise
+			except AsmError as e:
+				del self.pendingLabels[:]
+				self.addErrors(e)
+			for address, label, origin in self.fixups:
+				self.waiting.setdefault(label, []).append((address, origin))
+			del self.fixups[:]
+			del self.code[:]
+			del self.origins[:]
+			if len(self.image) >= self.flushSize:
+				self.flush(out)
+		for label, references in self.waiting.items():
+			for address, origin in references:
+				self.diagnostics.add(Diagnostic('error', 'unknown label ' + label, origin))
+		self.diagnostics.check()
+		out.write(memRows(self.image))
+		return self.diagnostics.sorted()
+
+	# Define a label and patch the references to it
+	def defineLabel(self, label):
+		self.labels[label] = self.pc
+		for address, origin in self.waiting.pop(label, []):
+			self.image[address - self.base] = self.pc & 0xFFFF
+
+	# Write the full rows of words before the first unresolved reference
+	def flush(self, out):
+		limit = min([references[0][0] for references in self.waiting.values()], default=self.pc) - self.base
+		count = limit - limit % 8
+		if count > 0:
+			out.write(memRows(self.image[:count]))
+			del self.image[:count]
+			self.base += count
+
+# Assemble a program given as source text, returns its Image
+def assemble(source, pyparsing=False, optimize=0, fname=None, maxErrors=defaultMaxErrors):
+	return Assembler(pyparsing, optimize, maxErrors).assemble(source, fname)
+
+# Compute the name of an output file (.mem, .lst) from the name of the source file
+def outputName(srcfname, ext):
+	dotpos = srcfname.rfind('.')
+	if dotpos == -1:
+		return srcfname + ext
+	return srcfname[0:dotpos] + ext
+
+# Version of the generated code, to be changed when the output of the assembler changes
+# for the same source, so that outdated entries of the assembly cache are not used
+assemblerVersion = '3'
+
+defaultCacheDir = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.expanduser('~/.cache')), 'miniarm-asm')
+defaultCacheSize = 256   # MB
+
+# Content addressed cache of assembled programs
+# The .mem and .lst files of a program (and its .sym and .map files if they are written) are
+# stored under a hash of its source text, of the version of the assembler and of its options,
+# with its warnings and optimization report in a .json file so that they are reported again.
+# Least recently used entries are removed when the cache exceeds its maximum size.
+class AssemblyCache:
+	def __init__(self, directory=defaultCacheDir, maxsize=defaultCacheSize << 20):
+		self.directory = directory
+		self.maxsize = maxsize
+		os.makedirs(directory, exist_ok=True)
+
+	def key(self, srctext, signature):
+		h = hashlib.sha256()
+		h.update((assemblerVersion + '\0' + signature + '\0').encode())
+		h.update(srctext.encode())
+		return h.hexdigest()
+
+	def entryName(self, key, ext):
+		return os.path.join(self.directory, key + ext)
+
+	# Copy the cached memory image (in the output format of the entry) and .lst files of a program,
+	# and the other files given as (extension, file name) entries
+	# Returns the diagnostics and the optimization report of the program, None if it is not in the cache
+	def lookup(self, key, binfname, lstfname, others=()):
+		try:
+			with open(self.entryName(key, '.json')) as resultfile:
+				result = json.load(resultfile)
+			for ext, fname in others:
+				shutil.copyfile(self.entryName(key, ext), fname)
+			shutil.copyfile(self.entryName(key, '.mem'), binfname)
+			shutil.copyfile(self.entryName(key, '.lst'), lstfname)
+		except FileNotFoundError:
+			return None
+		os.utime(self.entryName(key, '.mem'))   # most recently used
+		diagnostics = [Diagnostic(severity, msg, tuple(origin) if origin else None, column)
+		               for severity, msg, origin, column in result['diagnostics']]
+		return diagnostics, result['report']
+
+	# Store the memory image file and the listing of a program, and its other files
+	# given as (extension, file name) entries, with its diagnostics and optimization report
+	def store(self, key, binfname, lsttext, others=(), diagnostics=(), report=None):
+		# The memory image is written last since it marks a complete entry,
+		# and files are renamed into place for concurrent workers.
+		tmpfname = self.entryName(key, '.lst.' + str(os.getpid()))
+		with open(tmpfname, 'w') as tmpfile:
+			tmpfile.write(lsttext)
+		os.replace(tmpfname, self.entryName(key, '.lst'))
+		tmpfname = self.entryName(key, '.json.' + str(os.getpid()))
+		with open(tmpfname, 'w') as tmpfile:
+			json.dump({'diagnostics': [(d.severity, d.msg, d.origin, d.column) for d in diagnostics],
+			           'report': report}, tmpfile)
+		os.replace(tmpfname, self.entryName(key, '.json'))
+		for ext, fname in list(others) + [('.mem', binfname)]:
+			tmpfname = self.entryName(key, ext + '.' + str(os.getpid()))
+			shutil.copyfile(fname, tmpfname)
+			os.replace(tmpfname, self.entryName(key, ext))
+
+	# Remove least recently used entries until the cache fits into its maximum size
+	def evict(self):
+		entries = []
+		total = 0
+		for entry in os.scandir(self.directory):
+			if entry.name.endswith('.mem'):
+				key = entry.name[:-4]
+				try:
+					size = entry.stat().st_size + os.stat(self.entryName(key, '.lst')).st_size
+				except FileNotFoundError:
+					continue
+				for ext in ('.json',) + sidecarExtensions:
+					if os.path.exists(self.entryName(key, ext)):
+						size += os.stat(self.entryName(key, ext)).st_size
+				entries.append((entry.stat().st_mtime, key, size))
+				total += size
+		entries.sort()
+		for mtime, key, size in entries:
+			if total <= self.maxsize:
+				break
+			for ext in ('.mem', '.lst', '.json') + sidecarExtensions:
+				try:
+					os.remove(self.entryName(key, ext))
+				except FileNotFoundError:
+					pass
+			total -= size
+
+# Symbol table and source map files, written with --map
+sidecarExtensions = ('.sym', '.map')
+
+# Assembler and cache of a batch worker process, reused for all the files of the worker
+workerAssembler = None
+workerCache = None
+workerFormat = 'logisim'
+workerMap = False
+
+def initWorker(pyparsing, cachedir=None, optimize=0, fmt='logisim', maxErrors=defaultMaxErrors, writeMap=False):
+	global workerAssembler, workerCache, workerFormat, workerMap
+	
+	workerAssembler = Assembler(pyparsing, optimize, maxErrors)
+	workerFormat = fmt
+	workerMap = writeMap
+	if pyparsing:
+		parseSourcePyparsing('')   # build the grammar once per worker
+	workerCache = AssemblyCache(cachedir) if cachedir else None
+
+# Assemble a source file into its memory image (.mem, .bin or .hex) and .lst files, and its
+# .sym and .map files with --map
+# Returns the list of diagnostics (see Diagnostic) and the optimization report (None if not
+# optimized), those of the first assembly for programs found in the cache
+def assembleFile(srcfname):
+	binfname = outputName(srcfname, outputFormats[workerFormat])
+	lstfname = outputName(srcfname, '.lst')
+	sidecars = [(ext, outputName(srcfname, ext)) for ext in sidecarExtensions] if workerMap else []
+	try:
+		with open(srcfname) as srcfile:
+			srctext = srcfile.read()
+		if workerCache:
+			# Included files are part of the source of the program
+			included = includedSources(srctext, os.path.dirname(srcfname))
+			signature = workerAssembler.signature() + ' format=' + workerFormat + ' map=' + str(workerMap)
+			if workerMap:
+				# The source map holds the name of the source file
+				signature += ' source=' + srcfname
+			key = workerCache.key(srctext + ''.join([path + '\n' + text for path, text in included]), signature)
+			cached = workerCache.lookup(key, binfname, lstfname, sidecars)
+			if cached:
+				return cached
+		# An optimized program is also checked against the original one, before writing it
+		image = workerAssembler.assemble(srctext, srcfname)
+		report = image.report
+		lsttext = image.listing()
+		image.write(binfname, workerFormat)
+		with open(lstfname, 'w') as lstfile:
+			lstfile.write(lsttext)
+		if workerMap:
+			with open(outputName(srcfname, '.sym'), 'w') as symfile:
+				symfile.write(image.symbols())
+			with open(outputName(srcfname, '.map'), 'wb') as mapfile:
+				mapfile.write(image.sourceMap(srcfname))
+		if workerCache:
+			workerCache.store(key, binfname, lsttext, sidecars, image.diagnostics, report)
+	except AsmError as e:
+		return e.diagnostics, None
+	except (OSError, UnicodeDecodeError) as e:
+		return [Diagnostic('error', str(e))], None
+	return image.diagnostics, report
+
+# Source files given on the command line: files, directories (all their .s files) or glob patterns
+def expandSources(names):
+	fnames = []
+	for name in names:
+		if os.path.isdir(name):
+			fnames.extend(sorted(glob.glob(os.path.join(name, '*.s'))))
+		elif glob.has_magic(name):
+			fnames.extend(sorted(glob.glob(name)))
+		else:
+			fnames.append(name)
+	return fnames
+
+# Assemble source files, in parallel in jobs processes if jobs > 1
+# Yields (source file name, diagnostics, optimization report) in the order of fnames
+def assembleFiles(fnames, jobs=1, pyparsing=False, cachedir=None, optimize=0, fmt='logisim',
+                  maxErrors=defaultMaxErrors, writeMap=False):
+	if jobs <= 1 or len(fnames) <= 1:
+		initWorker(pyparsing, cachedir, optimize, fmt, maxErrors, writeMap)
+		for fname in fnames:
+			yield (fname,) + assembleFile(fname)
 		return
+	# Large chunks keep the inter-process traffic low, several chunks per worker balance the load
+	chunksize = max(1, len(fnames) // (4 * jobs))
+	with concurrent.futures.ProcessPoolExecutor(jobs, initializer=initWorker, initargs=(pyparsing, cachedir, optimize, fmt, maxErrors, writeMap)) as pool:
+		for fname, result in zip(fnames, pool.map(assembleFile, fnames, chunksize=chunksize)):
+			yield (fname,) + result
+
+# Diagnostic of a source file for the console
+def formatDiagnostic(fname, diagnostic):
+	return '# {}: {}, {}'.format(diagnostic.severity.capitalize(), fname, diagnostic)
+
+# Write the diagnostics of source files, given as (file name, diagnostics) entries, as a JSON list
+# of {"severity", "file", "line", "column", "macro", "message"} objects
+def writeDiagnostics(jsonfname, results):
+	entries = [diagnostic.asDict(fname) for fname, diagnostics in results for diagnostic in diagnostics]
+	if jsonfname == '-':
+		json.dump(entries, sys.stdout, indent=1)
+		sys.stdout.write('\n')
 	else:
-		print('# Error: unsupported instruction ' + str(line[idx][0]))
-		sys.exit(1)
-	if not(firstPass):
-		performOutput(line, bcode, instrpc)
-	return
-
-# Length of longest label (for formatting the listing)
-maxlabellen = 0
-pc = 0
-# Firstly, compute the address of labels
-for line in p:
-	idx = 0
-	if line[0][0] == '@':
-		labels[line[0][1]] = pc
-		idx = 1
-		l = len(line[0][1])
-		if l > maxlabellen:
-			maxlabellen = l
-	dispatchInstr(line)
+		with open(jsonfname, 'w') as jsonfile:
+			json.dump(entries, jsonfile, indent=1)
+
+def main(argv=None):
+	argparser = argparse.ArgumentParser(description='Assembler for mini ARM processor')
+	argparser.add_argument('source', nargs='+', help='assembly source files, directories of .s files or glob patterns '
+	                                                 '(- to read the source from the standard input and write the memory image '
+	                                                 'to the standard output as it is assembled)')
+	argparser.add_argument('-j', '--jobs', type=int, default=1,
+	                       help='number of worker processes (0 for one per CPU)')
+	argparser.add_argument('--pyparsing', action='store_true',
+	                       help='parse with the reference pyparsing grammar instead of the line parser')
+	argparser.add_argument('-f', '--format', choices=sorted(outputFormats), default='logisim',
+	                       help='format of the memory image: Logisim text (.mem), little or big endian binary (.bin) '
+	                            'or Intel HEX (.hex) (default: %(default)s)')
+	argparser.add_argument('-O', '--optimize', action='count', default=0,
+	                       help='optimize the program (-O: peephole optimizer, -OO: also relax branches and addresses '
+	                            'to registers) and report the size and cycles before and after')
+	argparser.add_argument('-m', '--map', action='store_true',
+	                       help='also write the symbol table (.sym, labels sorted by address) and the source map '
+	                            '(.map, source line of each address)')
+	argparser.add_argument('--max-errors', type=int, default=defaultMaxErrors, metavar='N',
+	                       help='stop assembling a program after N errors, 0 for no limit (default: %(default)s)')
+	argparser.add_argument('--json', metavar='FILE',
+	                       help='also write the errors and warnings of all the programs to FILE in JSON format '
+	                            '(- for the standard output)')
+	argparser.add_argument('--check-parser', action='store_true',
+	                       help='only check that both parsers agree on the source files')
+	argparser.add_argument('--no-cache', action='store_true',
+	                       help='do not use the assembly cache')
+	argparser.add_argument('--cache-dir', default=defaultCacheDir,
+	                       help='directory of the assembly cache (default: %(default)s)')
+	argparser.add_argument('--cache-size', type=int, default=defaultCacheSize,
+	                       help='maximum size of the assembly cache in MB (default: %(default)s)')
+	args = argparser.parse_args(argv)
+
+	if args.source == ['-']:
+		if args.optimize or args.pyparsing or args.format != 'logisim' or args.map:
+			argparser.error('-O, --pyparsing, --format and --map cannot be used when reading the standard input')
+		if args.json == '-':
+			argparser.error('the memory image is written to the standard output, --json needs a file')
+		try:
+			diagnostics = StreamAssembler(maxErrors=args.max_errors).assembleStream(sys.stdin, sys.stdout)
+			failed = False
+		except AsmError as e:
+			diagnostics = e.diagnostics
+			failed = True
+		for diagnostic in diagnostics:
+			sys.stderr.write(formatDiagnostic('<stdin>', diagnostic) + '\n')
+		if args.json:
+			writeDiagnostics(args.json, [('<stdin>', diagnostics)])
+		return 1 if failed else 0
 
-# Now, do the assembly
-pc = 0
-firstPass = False
+	fnames = expandSources(args.source)
+	# The console messages go to the standard error when the JSON output takes the standard output
+	console = sys.stderr if args.json == '-' else sys.stdout
+	if args.check_parser:
+		return 0 if checkParser(fnames) else 1
+	jobs = args.jobs if args.jobs > 0 else os.cpu_count()
+	cache = None
+	if not args.no_cache:
+		try:
+			cache = AssemblyCache(args.cache_dir, args.cache_size << 20)
+		except OSError as e:
+			print('# Warning: assembly cache disabled, ' + str(e), file=console)
 
-for line in p:
-	dispatchInstr(line)
+	failed = 0
+	cachedir = cache.directory if cache else None
+	results = []
+	for fname, diagnostics, report in assembleFiles(fnames, jobs, args.pyparsing, cachedir, args.optimize,
+	                                                args.format, args.max_errors, args.map):
+		for diagnostic in diagnostics:
+			print(formatDiagnostic(fname, diagnostic), file=console)
+		results.append((fname, diagnostics))
+		if any([diagnostic.severity == 'error' for diagnostic in diagnostics]):
+			failed += 1
+		elif report:
+			print('# ' + fname + ': optimized, ' + report, file=console)
+		elif len(fnames) > 1:
+			print('# ' + fname + ': OK', file=console)
+	if len(fnames) > 1:
+		print('# {} file(s) assembled, {} failed'.format(len(fnames) - failed, failed), file=console)
+	if args.json:
+		writeDiagnostics(args.json, results)
+	if cache:
+		cache.evict()
+	return 1 if failed else 0
 
-binfile.close()
-lstfile.close()
-exit()
+if __name__ == '__main__':
+	# Run from the assembler module, so that the optimizer, the simulator and the worker
+	# processes (which import it) share its classes, such as AsmError
+	import assembler
+	sys.exit(assembler.main())
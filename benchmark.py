@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# Benchmark of the assembler
+# Assembles synthetic programs of increasing size and the example programs, timing each
+# phase separately:
+#  - parse: reading and parsing the source
+#  - encode: the single pass which lays out the labels and encodes the instructions
+#  - fixups: patching the forward references
+#  - mem, lst, bin: writing the Logisim memory image, the listing and the binary image
+# Each program is assembled in its own process, so that its peak memory can be measured.
+# Results are saved as JSON, and can be compared with those of a previous run.
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from assembler import Assembler
+
+# Number of lines of the synthetic programs
+corpusSizes = {
+	'1k': 1000,
+	'10k': 10000,
+	'100k': 100000,
+	'1M': 1000000
+}
+
+# Example programs, in the directory of this script
+examplePrograms = ['fibo.s', 'fibotab.s', 'test.s']
+
+phases = ['parse', 'encode', 'fixups', 'mem', 'lst', 'bin']
+
+defaultCorpusDir = os.path.join(tempfile.gettempdir(), 'miniarm-benchmark')
+
+# Size of the address space, which the synthetic programs must fit into
+addressSpace = 1 << 16
+
+# Number of lines of code (about 1.4 words each) which fill most of the address space
+# Larger programs have comment lines between their blocks to reach their number of lines.
+maxCodeLines = 35000
+
+# Words kept for the end of the program: end and sub, the referenced labels which were not
+# generated and the stack
+tailWords = 128
+
+# Version of the synthetic programs, to be changed when generateProgram changes
+corpusVersion = 2
+
+# Synthetic program of about nlines lines, always the same for the same seed
+# It is made of blocks of code (with forward and backward branches, push/pop, calls and
+# accesses to tables), of smw tables and of large rmw reservations. The program fits into
+# the address space: the reservations only take the words left by the code, and the programs
+# of more than maxCodeLines lines are diluted with comments.
+def generateProgram(nlines, seed=0):
+	rnd = random.Random(seed)
+	out = ['% Synthetic program of {} lines for benchmark.py'.format(nlines),
+	       '@start  mov sp, #stack']
+	defined = set(['start', 'stack', 'end', 'sub'])
+	referenced = set()
+	block = 0
+	tables = 0
+	reserves = 0
+	words = 2
+	# Comment lines per line of code, and comment lines owed
+	dilution = max(nlines / maxCodeLines - 1, 0)
+	comments = 0.0
+	while len(out) < nlines - 8:
+		start = len(out)
+		kind = rnd.random()
+		# Space left for the reservations, at most 3 words per line for the rest of the code
+		free = addressSpace - tailWords - words - int(3 * (nlines - len(out)) / (1 + dilution))
+		if words + 3 * 101 > addressSpace - tailWords:
+			# No room left for a block or a table
+			out.append('% (address space full)')
+		elif kind < 0.75:
+			# Block of code
+			out.append('@L{}'.format(block))
+			defined.add('L{}'.format(block))
+			for i in range(rnd.randint(8, 24)):
+				rx, ry, rz = rnd.randint(0, 5), rnd.randint(0, 5), rnd.randint(0, 5)
+				choice = rnd.random()
+				if choice < 0.2:
+					out.append('        mov r{}, #{}'.format(rx, rnd.randint(-100, 1000)))
+					words += 2
+				elif choice < 0.35:
+					out.append('        add r{}, r{}, r{}'.format(rx, ry, rz))
+					words += 1
+				elif choice < 0.45:
+					out.append('        sub r{}, r{}, #0x{:X}'.format(rx, ry, rnd.randint(0, 255)))
+					words += 2
+				elif choice < 0.55:
+					out.append('        cmp r{}, r{}'.format(rx, ry))
+					words += 1
+				elif choice < 0.65:
+					target = 'L{}'.format(block + rnd.randint(1, 5))
+					referenced.add(target)
+					out.append('        {} {}'.format(rnd.choice(['beq', 'blt']), target))
+					words += 2
+				elif choice < 0.72:
+					out.append('        push r{}'.format(rx))
+					out.append('        pop r{}'.format(ry))
+					words += 6
+				elif choice < 0.82:
+					table = 'T{}'.format(rnd.randint(0, tables + 10))
+					referenced.add(table)
+					out.append('        {} r{}, {}'.format(rnd.choice(['ldr', 'str']), rx, table))
+					words += 2
+				elif choice < 0.9:
+					out.append('        bl r7, sub')
+					words += 2
+				elif block > 0:
+					out.append('        b L{}'.format(rnd.randint(max(0, block - 5), block - 1)))
+					words += 2
+				else:
+					out.append('        mov r{}, r{}'.format(rx, ry))
+					words += 1
+			block += 1
+		elif kind < 0.97:
+			# Table of values
+			out.append('@T{}     smw 0x{:04X}'.format(tables, rnd.randint(0, 0xFFFF)))
+			defined.add('T{}'.format(tables))
+			for i in range(rnd.randint(20, 100)):
+				if rnd.random() < 0.5:
+					out.append('        smw {}'.format(rnd.randint(-32768, 32767)))
+				else:
+					out.append('        smw 0x{:04X}'.format(rnd.randint(0, 0xFFFF)))
+			words += len(out) - start
+			tables += 1
+		elif free >= 100:
+			# Large reservation
+			size = min(rnd.randint(100, 5000), free)
+			out.append('@R{}     rmw {}'.format(reserves, size))
+			words += size
+			reserves += 1
+		comments += dilution * (len(out) - start)
+		while comments >= 1 and len(out) < nlines - 8:
+			out.append('% {} {} {}'.format(rnd.choice(['Block', 'Table', 'Step']), block, rnd.choice(['done', 'checked', 'next'])))
+			comments -= 1
+	out.append('@end    b end')
+	out.append('@sub    add r0, r0, #1')
+	out.append('        b r7')
+	# Labels which are referenced but were not generated
+	for label in sorted(referenced - defined):
+		out.append('@{} smw 0'.format(label))
+	out.append('@stack  rmw 64')
+	return '\n'.join(out) + '\n'
+
+# Name of the file of a synthetic program, generated if it does not exist
+def corpusFile(corpusdir, size):
+	fname = os.path.join(corpusdir, 'synthetic-{}-v{}.s'.format(size, corpusVersion))
+	if not os.path.exists(fname):
+		os.makedirs(corpusdir, exist_ok=True)
+		tmpfname = fname + '.' + str(os.getpid())
+		with open(tmpfname, 'w') as f:
+			f.write(generateProgram(corpusSizes[size]))
+		os.replace(tmpfname, fname)
+	return fname
+
+# Peak memory of the current process in bytes, None if it is not available
+def peakMemory():
+	try:
+		import resource
+	except ImportError:
+		return None
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	return peak if sys.platform == 'darwin' else peak * 1024
+
+# Assemble a program repeat times, and return the best time of each phase
+def runCase(fname, repeat):
+	times = dict([(phase, float('inf')) for phase in phases])
+	with tempfile.TemporaryDirectory() as outdir:
+		outname = os.path.join(outdir, 'out')
+		for i in range(repeat):
+			asm = Assembler()
+			t0 = time.perf_counter()
+			with open(fname) as f:
+				lines = asm.parse(f.read(), fname)
+			t1 = time.perf_counter()
+			asm.encode(lines)
+			t2 = time.perf_counter()
+			image = asm.link()
+			t3 = time.perf_counter()
+			image.write(outname + '.mem')
+			t4 = time.perf_counter()
+			with open(outname + '.lst', 'w') as lstfile:
+				lstfile.write(image.listing())
+			t5 = time.perf_counter()
+			image.write(outname + '.bin', 'bin-le')
+			t6 = time.perf_counter()
+			for phase, t in zip(phases, (t1 - t0, t2 - t1, t3 - t2, t4 - t3, t5 - t4, t6 - t5)):
+				times[phase] = min(times[phase], t)
+			nlines = len(lines)
+			del lines, image
+	return {
+		'name': os.path.basename(fname),
+		'lines': nlines,
+		'words': len(asm.image),
+		'times': times,
+		'total': sum(times.values()),
+		'peak_memory': peakMemory()
+	}
+
+# Run a case in a new process
+def runCaseProcess(fname, repeat):
+	script = os.path.abspath(__file__)
+	result = subprocess.run([sys.executable, script, '--case', fname, '--repeat', str(repeat)],
+	                        stdout=subprocess.PIPE, check=True, universal_newlines=True)
+	return json.loads(result.stdout)
+
+# Identifier of the current commit, None if not in a git repository
+def gitCommit():
+	try:
+		result = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+		                        stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, universal_newlines=True)
+	except OSError:
+		return None
+	return result.stdout.strip() if result.returncode == 0 else None
+
+def printResults(results, previous=None):
+	print('# {:18s} {:>8s} {:>8s} '.format('program', 'lines', 'words')
+	      + ' '.join(['{:>8s}'.format(phase) for phase in phases])
+	      + ' {:>8s} {:>8s}'.format('total', 'peak MB')
+	      + (' {:>8s}'.format('vs prev') if previous else ''))
+	for result in results:
+		peak = result['peak_memory']
+		line = '  {:18s} {:8d} {:8d} '.format(result['name'], result['lines'], result['words']) \
+		     + ' '.join(['{:8.4f}'.format(result['times'][phase]) for phase in phases]) \
+		     + ' {:8.4f} {:>8s}'.format(result['total'], '{:.1f}'.format(peak / 1e6) if peak else '-')
+		if previous and result['name'] in previous:
+			line += ' {:7.2f}x'.format(result['total'] / previous[result['name']]['total'])
+		print(line)
+
+def main(argv=None):
+	argparser = argparse.ArgumentParser(description='Benchmark of the mini ARM assembler')
+	argparser.add_argument('--sizes', default=','.join(corpusSizes),
+	                       help='sizes of the synthetic programs, among {} (default: %(default)s)'.format(', '.join(corpusSizes)))
+	argparser.add_argument('--repeat', type=int, default=3,
+	                       help='number of runs of each program, the best time is kept (default: %(default)s)')
+	argparser.add_argument('--corpus-dir', default=defaultCorpusDir,
+	                       help='directory of the synthetic programs (default: %(default)s)')
+	argparser.add_argument('-o', '--output', default='benchmark.json',
+	                       help='JSON file of the results (default: %(default)s)')
+	argparser.add_argument('--compare', metavar='JSON',
+	                       help='results of a previous run to compare with')
+	argparser.add_argument('--case', help=argparse.SUPPRESS)
+	args = argparser.parse_args(argv)
+
+	if args.case:
+		# Child process running a single program
+		json.dump(runCase(args.case, args.repeat), sys.stdout)
+		return 0
+
+	sizes = [size for size in args.sizes.split(',') if size]
+	for size in sizes:
+		if size not in corpusSizes:
+			argparser.error('unknown size ' + size)
+	here = os.path.dirname(os.path.abspath(__file__))
+	fnames = [os.path.join(here, name) for name in examplePrograms]
+	fnames += [corpusFile(args.corpus_dir, size) for size in sizes]
+	results = []
+	for fname in fnames:
+		results.append(runCaseProcess(fname, args.repeat))
+	previous = None
+	if args.compare:
+		with open(args.compare) as f:
+			previous = dict([(result['name'], result) for result in json.load(f)['results']])
+	printResults(results, previous)
+	with open(args.output, 'w') as f:
+		json.dump({
+			'commit': gitCommit(),
+			'date': datetime.datetime.now().isoformat(timespec='seconds'),
+			'python': platform.python_version(),
+			'repeat': args.repeat,
+			'results': results
+		}, f, indent=1)
+	print('# Results saved in ' + args.output)
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
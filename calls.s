@@ -0,0 +1,25 @@
+%
+% Program for checking the optimizer (python assembler.py -OO calls.s)
+%
+% A loop calls a subroutine which has its own loop: the registers loaded
+% before the loop of the subroutine must not be those of the calling loop.
+% It should stop by looping at label 'end' with r0 = 6 (2 calls * 3 iterations)
+%
+        mov r0,#0       % counter of the iterations of inner
+        mov r1,#2       % number of calls
+@outer  bl r7,sub       % call sub
+        sub r1,r1,#1    % one call less
+        cmp r1,#0       % is it the last one?
+        beq end         % yes => end
+        blt outer       % (never taken)
+        b outer         % no, call again
+@end    b end           % end of program, loop here
+
+% Adds 3 to r0, one iteration of inner at a time
+@sub    mov r2,#3       % number of iterations
+@inner  add r0,r0,#1    % one more iteration
+        sub r2,r2,#1
+        cmp r2,#0       % is it the last one?
+        beq done        % yes => return
+        b inner         % no, continue
+@done   b r7            % return
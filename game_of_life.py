@@ -1,4 +1,8 @@
-import pyb
+try:
+    import pyb
+except ImportError:
+    # Hors de la carte, les pattes et les délais sont simulés (voir mock_pyb.py)
+    import mock_pyb as pyb
 import os
 
  
@@ -40,40 +44,121 @@ def serialWrite(address, data):
     loadPin.high()
     loadPin.low()
 
+# Pilote de chips MAX7219 chaînés (DOUT de chaque circuit relié à DIN du suivant), qui
+# garde une copie des lignes envoyées (shadow), pour n'envoyer que les lignes qui ont changé.
+# L'image (frame) est faite des 8 lignes de chaque circuit : frame[8 * chip + k] est la ligne k
+# du circuit chip, le circuit 0 étant celui qui est relié à la carte. Avec un seul circuit,
+# c'est un bitmap. Une ligne de tous les circuits est envoyée avec un seul front sur CS.
+# Les registres sont écrits par le bus SPI matériel spi (pyb.SPI, CLK et DIN sur les pattes
+# SCK et MOSI du bus, CS restant sur la patte load) ou, sans spi, bit par bit.
+class Max7219:
+    def __init__(self, spi=None, chips=1):
+        self.spi = spi
+        self.chips = chips
+        # Une adresse et une donnée par circuit, pour le dernier circuit de la chaîne en premier
+        self.buffer = bytearray(2 * chips)
+        # Dernières lignes envoyées, inconnues au démarrage
+        self.shadow = bytearray(8 * chips)
+        self.valid = False
+
+    # Envoi du buffer, puis chargement des registres de tous les circuits
+    def send(self):
+        loadPin.low()
+        if self.spi is None:
+            for byte in self.buffer:
+                serialShiftByte(byte)
+        else:
+            self.spi.send(self.buffer)
+        # front montant sur CS pour charger les données dans les registres
+        loadPin.high()
+        loadPin.low()
+
+    # Écriture d'une donnée dans le même registre de tous les circuits
+    # (les registres 1 à 8 sont les lignes)
+    def write(self, address, data):
+        for chip in range(self.chips):
+            if 1 <= address <= 8:
+                self.shadow[8 * chip + address - 1] = data
+            self.buffer[2 * chip] = address
+            self.buffer[2 * chip + 1] = data
+        self.send()
+
+    # Écriture de la ligne k de tous les circuits
+    def writeRow(self, k, frame):
+        for chip in range(self.chips):
+            i = 2 * (self.chips - 1 - chip)
+            self.buffer[i] = k + 1
+            self.buffer[i + 1] = frame[8 * chip + k]
+            self.shadow[8 * chip + k] = frame[8 * chip + k]
+        self.send()
+
+    # Affichage d'une image, en n'envoyant que les lignes dont l'un des circuits a changé
+    # Renvoie le nombre de lignes envoyées.
+    def update(self, frame):
+        count = 0
+        for k in range(8):
+            changed = not self.valid
+            for chip in range(self.chips):
+                if frame[8 * chip + k] != self.shadow[8 * chip + k]:
+                    changed = True
+            if changed:
+                self.writeRow(k, frame)
+                count += 1
+        self.valid = True
+        return count
+
+    # Les lignes seront toutes envoyées à la prochaine mise à jour
+    def invalidate(self):
+        self.valid = False
+
+# Pilote de l'afficheur, par défaut sur les pattes data, load et clk
+display = Max7219()
+
+# Utilisation du bus SPI matériel numéro bus s'il est disponible (CLK et DIN doivent alors
+# être reliés aux pattes SCK et MOSI du bus, X6 et X8 pour le bus 1), sinon les registres
+# restent écrits bit par bit. Renvoie vrai si le bus SPI est utilisé.
+def useSPI(bus=1, baudrate=1000000, chips=1):
+    global display
+    try:
+        spi = pyb.SPI(bus, pyb.SPI.MASTER, baudrate=baudrate, polarity=0, phase=0)
+    except (AttributeError, ValueError):
+        return False
+    display = Max7219(spi, chips)
+    return True
+
 def matrixOn(on):
  if on:
-  serialWrite(0x0c,1)
+  display.write(0x0c,1)
  else:
-  serialWrite(0x0c,0)
+  display.write(0x0c,0)
 
 def matrixTest(test):
  if test:
-  serialWrite(0x0f,1)
+  display.write(0x0f,1)
  else:
-  serialWrite(0x0f,0)
+  display.write(0x0f,0)
 
 def matrixIntensity(percent):
- serialWrite(0x0a,int(15*percent/100))
+ display.write(0x0a,int(15*percent/100))
 
 def matrixDecode(decode):
  if decode:
-  serialWrite(0x09, 0xff)
+  display.write(0x09, 0xff)
  else:
-  serialWrite(0x09,0)
+  display.write(0x09,0)
 
 def matrixDigits(num):
- serialWrite(0x0b, num)
+ display.write(0x0b, num)
 
 def matrixLine(num,value):
- serialWrite(num, value)
+ display.write(num, value)
 
 bitmap=bytearray(8)
 
 
 
 def updateDisplay(bitmap):
- for k in range(8):
-  serialWrite((k+1),bitmap[k])
+ display.update(bitmap)
 
 def clearDisplay(bitmap):
  bitmap=bytearray(8)
@@ -174,23 +259,531 @@ def countNeighbours(x,y,bitmap):
     counter+=int(getPixel((x+i)%8,(y+j)%8,bitmap))
  return counter
 
+# Grille de W x H pixels, rangés comme dans bitmap : le pixel (x, y) est le bit y de la
+# ligne x, chaque ligne étant un entier de W bits. Les lignes peuvent être celles d'un
+# bitmap (bytearray) pour une grille de 8 pixels de large, qui est alors modifié en place.
+# Si wrap est vrai, les bords opposés se touchent (tore), sinon les pixels hors de la
+# grille sont morts.
+class Grid:
+    def __init__(self, width, height, wrap=True, rows=None):
+        self.width = width
+        self.height = height
+        self.wrap = wrap
+        self.mask = (1 << width) - 1
+        self.rows = rows if rows is not None else [0] * height
+
+    def getPixel(self, x, y):
+        return bool(self.rows[x] >> y & 1)
+
+    def setPixel(self, x, y, on):
+        if on:
+            self.rows[x] = self.rows[x] | (1 << y)
+        else:
+            self.rows[x] = self.rows[x] & ~(1 << y) & self.mask
+
+    # Ligne dont le bit y est le bit y-1 de row, et ligne dont le bit y est le bit y+1
+    def shiftLeft(self, row):
+        if self.wrap:
+            return ((row << 1) | (row >> (self.width - 1))) & self.mask
+        return (row << 1) & self.mask
+
+    def shiftRight(self, row):
+        if self.wrap:
+            return (row >> 1) | ((row & 1) << (self.width - 1))
+        return row >> 1
+
+    # Génération suivante, calculée sur tous les pixels d'une ligne à la fois :
+    # les voisins sont comptés bit à bit avec des additionneurs (somme et retenue
+    # de chaque bit dans un entier), sur les lignes décalées d'un pixel.
+    def step(self):
+        rows = self.rows
+        height = self.height
+        # Pour chaque ligne, somme des 3 pixels voisins horizontalement (pixel compris),
+        # sur 2 bits (s3, c3), et des 2 voisins seuls (s2, c2). Une ligne vide est ajoutée
+        # à la fin pour les bords d'une grille qui n'est pas un tore.
+        s3 = [0] * (height + 1)
+        c3 = [0] * (height + 1)
+        s2 = [0] * height
+        c2 = [0] * height
+        for k in range(height):
+            row = rows[k]
+            left = self.shiftLeft(row)
+            right = self.shiftRight(row)
+            s2[k] = left ^ right
+            c2[k] = left & right
+            s3[k] = s2[k] ^ row
+            c3[k] = c2[k] | (s2[k] & row)
+        for k in range(height):
+            if self.wrap:
+                up = (k - 1) % height
+                down = (k + 1) % height
+            else:
+                up = k - 1          # -1 : ligne vide
+                down = k + 1        # height : ligne vide
+            # Bit de poids 1 du nombre de voisins, et sa retenue
+            a = s3[up]
+            b = s2[k]
+            c = s3[down]
+            ones = a ^ b ^ c
+            carry = (a & b) | (c & (a ^ b))
+            # Bits de poids 2 : il en faut exactement un pour avoir 2 ou 3 voisins
+            a = c3[up]
+            b = c2[k]
+            c = c3[down]
+            d = carry
+            twos = (a ^ b ^ c ^ d) & ~(((a & b) & (c | d)) | ((c & d) & (a | b)))
+            # Naissance avec 3 voisins, survie avec 2 ou 3
+            rows[k] = twos & (ones | rows[k]) & self.mask
+
+    # Place une figure (tuple de chaînes, comme pour displayPict) à partir du pixel (x, y)
+    def load(self, pict, x=0, y=0):
+        for k in range(len(pict)):
+            for i in range(len(pict[k])):
+                self.setPixel((x + k) % self.height, (y + i) % self.width, pict[k][i] != " ")
+
+    # Fenêtre de 8x8 pixels à partir du pixel (x, y), sous forme de bitmap pour updateDisplay
+    def window(self, x=0, y=0):
+        bitmap = bytearray(8)
+        for k in range(8):
+            if x + k < self.height:
+                bitmap[k] = (self.rows[x + k] >> y) & 0xff
+        return bitmap
+
+    # Image de chips fenêtres de 8x8 pixels côte à côte à partir du pixel (x, y), pour
+    # des circuits MAX7219 chaînés (voir Max7219)
+    def tiles(self, chips, x=0, y=0):
+        frame = bytearray(8 * chips)
+        for chip in range(chips):
+            frame[8 * chip:8 * chip + 8] = self.window(x, y + 8 * chip)
+        return frame
+
+# Grille dont les lignes sont des tableaux NumPy de mots de 64 bits, pour les grandes
+# grilles : chaque génération est calculée sur toute la grille en quelques dizaines
+# d'opérations NumPy. NumPy n'est nécessaire que pour cette classe.
+class NumpyGrid(Grid):
+    def __init__(self, width, height, wrap=True):
+        import numpy as np
+        self.np = np
+        self.width = width
+        self.height = height
+        self.wrap = wrap
+        self.words = (width + 63) // 64
+        # Bits utiles du dernier mot de chaque ligne
+        self.lastBits = width - 64 * (self.words - 1)
+        self.lastMask = np.uint64((1 << self.lastBits) - 1)
+        self.rows = np.zeros((height, self.words), dtype=np.uint64)
+
+    def getPixel(self, x, y):
+        return bool((int(self.rows[x, y // 64]) >> (y % 64)) & 1)
+
+    def window(self, x=0, y=0):
+        bitmap = bytearray(8)
+        for k in range(8):
+            for i in range(8):
+                if x + k < self.height and y + i < self.width and self.getPixel(x + k, y + i):
+                    bitmap[k] = bitmap[k] | (1 << i)
+        return bitmap
+
+    def setPixel(self, x, y, on):
+        bit = self.np.uint64(1 << (y % 64))
+        if on:
+            self.rows[x, y // 64] |= bit
+        else:
+            self.rows[x, y // 64] &= ~bit
+
+    def shiftLeft(self, rows):
+        np = self.np
+        out = rows << np.uint64(1)
+        out[:, 1:] |= rows[:, :-1] >> np.uint64(63)
+        if self.wrap:
+            out[:, 0] |= (rows[:, -1] >> np.uint64(self.lastBits - 1)) & np.uint64(1)
+        out[:, -1] &= self.lastMask
+        return out
+
+    def shiftRight(self, rows):
+        np = self.np
+        out = rows >> np.uint64(1)
+        out[:, :-1] |= rows[:, 1:] << np.uint64(63)
+        if self.wrap:
+            out[:, -1] |= (rows[:, 0] & np.uint64(1)) << np.uint64(self.lastBits - 1)
+        return out
+
+    # Lignes décalées d'une ligne vers le bas (la ligne k reçoit la ligne k-1) ou vers le haut
+    def shiftDown(self, rows):
+        if self.wrap:
+            return self.np.roll(rows, 1, axis=0)
+        out = self.np.zeros_like(rows)
+        out[1:] = rows[:-1]
+        return out
+
+    def shiftUp(self, rows):
+        if self.wrap:
+            return self.np.roll(rows, -1, axis=0)
+        out = self.np.zeros_like(rows)
+        out[:-1] = rows[1:]
+        return out
+
+    def step(self):
+        rows = self.rows
+        left = self.shiftLeft(rows)
+        right = self.shiftRight(rows)
+        s2 = left ^ right
+        c2 = left & right
+        s3 = s2 ^ rows
+        c3 = c2 | (s2 & rows)
+        a = self.shiftDown(s3)
+        b = s2
+        c = self.shiftUp(s3)
+        ones = a ^ b ^ c
+        carry = (a & b) | (c & (a ^ b))
+        a = self.shiftDown(c3)
+        b = c2
+        c = self.shiftUp(c3)
+        d = carry
+        twos = (a ^ b ^ c ^ d) & ~(((a & b) & (c | d)) | ((c & d) & (a | b)))
+        self.rows = twos & (ones | rows)
+
+# Noeud d'un quadtree de Hashlife : carré de 2^level pixels de côté, fait de quatre
+# carrés de 2^(level-1) pixels (nw en haut à gauche, ne en haut à droite, sw et se en bas),
+# ou pixel (level 0) vivant si population vaut 1. Les noeuds sont uniques pour un même
+# contenu (voir Hashlife.join), et peuvent donc être comparés par leur identité.
+class Node:
+    __slots__ = ('level', 'nw', 'ne', 'sw', 'se', 'population')
+
+    def __init__(self, level, nw, ne, sw, se, population):
+        self.level = level
+        self.nw = nw
+        self.ne = ne
+        self.sw = sw
+        self.se = se
+        self.population = population
+
+# Hashlife : les noeuds identiques sont partagés, et l'évolution de chaque noeud est
+# calculée une seule fois puis gardée en mémoire, ce qui permet d'avancer de 2^k
+# générations d'un coup sur les figures régulières (vaisseaux, oscillateurs).
+# Le plan est infini : contrairement à lifeStep, les bords ne se touchent pas.
+# Les pixels (x, y) sont rangés comme dans bitmap (x est la ligne, y la colonne).
+# Les évolutions gardées sont limitées à maxResults (les plus anciennes sont oubliées),
+# et les noeuds qui ne servent plus sont oubliés quand il y en a plus de maxNodes.
+class Hashlife:
+    def __init__(self, maxResults=1 << 20, maxNodes=1 << 22):
+        self.maxResults = maxResults
+        self.maxNodes = maxNodes
+        self.dead = Node(0, None, None, None, None, 0)
+        self.alive = Node(0, None, None, None, None, 1)
+        # Noeuds par (nw, ne, sw, se)
+        self.nodes = {}
+        # Noeuds vides par niveau
+        self.empty = [self.dead]
+        # Évolutions déjà calculées par (noeud, j) : centre du noeud après 2^j générations
+        self.results = {}
+        self.generation = 0
+        # Racine et position de son pixel en haut à gauche
+        self.root = self.emptyNode(3)
+        self.x = -4
+        self.y = -4
+
+    # Noeud unique de ce contenu
+    def join(self, nw, ne, sw, se):
+        key = (nw, ne, sw, se)
+        node = self.nodes.get(key)
+        if node is None:
+            node = Node(nw.level + 1, nw, ne, sw, se,
+                        nw.population + ne.population + sw.population + se.population)
+            self.nodes[key] = node
+        return node
+
+    def emptyNode(self, level):
+        while len(self.empty) <= level:
+            e = self.empty[-1]
+            self.empty.append(self.join(e, e, e, e))
+        return self.empty[level]
+
+    # Noeud du niveau supérieur ayant node en son centre
+    def centre(self, node):
+        e = self.emptyNode(node.level - 1)
+        return self.join(self.join(e, e, e, node.nw), self.join(e, e, node.ne, e),
+                         self.join(e, node.sw, e, e), self.join(node.se, e, e, e))
+
+    # Centre d'un carré de 4x4 pixels après une génération
+    def life4x4(self, node):
+        cells = [[0] * 4 for i in range(4)]
+        for qx, qy, q in ((0, 0, node.nw), (0, 2, node.ne), (2, 0, node.sw), (2, 2, node.se)):
+            cells[qx][qy] = q.nw.population
+            cells[qx][qy + 1] = q.ne.population
+            cells[qx + 1][qy] = q.sw.population
+            cells[qx + 1][qy + 1] = q.se.population
+        out = []
+        for x in (1, 2):
+            for y in (1, 2):
+                n = sum([cells[x + i][y + j] for i in (-1, 0, 1) for j in (-1, 0, 1)]) - cells[x][y]
+                out.append(self.alive if n == 3 or (n == 2 and cells[x][y]) else self.dead)
+        return self.join(out[0], out[1], out[2], out[3])
+
+    # Centre (de niveau level-1) d'un noeud après 2^j générations, avec j <= level-2
+    def successor(self, node, j):
+        if node.population == 0:
+            return self.emptyNode(node.level - 1)
+        key = (node, j)
+        result = self.results.get(key)
+        if result is not None:
+            return result
+        if node.level == 2:
+            result = self.life4x4(node)
+        else:
+            nw, ne, sw, se = node.nw, node.ne, node.sw, node.se
+            # Neuf carrés de niveau level-1 qui se chevauchent, avancés de 2^j générations
+            # (ou de la moitié quand j = level-2, la seconde moitié étant faite ensuite)
+            half = j if j < node.level - 2 else j - 1
+            c1 = self.successor(nw, half)
+            c2 = self.successor(self.join(nw.ne, ne.nw, nw.se, ne.sw), half)
+            c3 = self.successor(ne, half)
+            c4 = self.successor(self.join(nw.sw, nw.se, sw.nw, sw.ne), half)
+            c5 = self.successor(self.join(nw.se, ne.sw, sw.ne, se.nw), half)
+            c6 = self.successor(self.join(ne.sw, ne.se, se.nw, se.ne), half)
+            c7 = self.successor(sw, half)
+            c8 = self.successor(self.join(sw.ne, se.nw, sw.se, se.sw), half)
+            c9 = self.successor(se, half)
+            if j < node.level - 2:
+                result = self.join(self.join(c1.se, c2.sw, c4.ne, c5.nw), self.join(c2.se, c3.sw, c5.ne, c6.nw),
+                                   self.join(c4.se, c5.sw, c7.ne, c8.nw), self.join(c5.se, c6.sw, c8.ne, c9.nw))
+            else:
+                result = self.join(self.successor(self.join(c1, c2, c4, c5), half),
+                                   self.successor(self.join(c2, c3, c5, c6), half),
+                                   self.successor(self.join(c4, c5, c7, c8), half),
+                                   self.successor(self.join(c5, c6, c8, c9), half))
+        if len(self.results) >= self.maxResults:
+            # Oubli de la plus ancienne moitié des évolutions
+            for old in list(self.results)[:len(self.results) // 2]:
+                del self.results[old]
+        self.results[key] = result
+        return result
+
+    # Vrai si tous les pixels de node sont dans son carré central de niveau level-1
+    def isCentred(self, node):
+        inner = node.nw.se.population + node.ne.sw.population + node.sw.ne.population + node.se.nw.population
+        return inner == node.population
+
+    # Avance de 2^j générations
+    def jump(self, j):
+        # La figure doit rester dans la racine : celle-ci est agrandie jusqu'à ce que les
+        # pixels soient dans son carré central, à au moins 2^j pixels du bord
+        while self.root.level < j + 2 or not self.isCentred(self.root):
+            self.grow()
+        self.root = self.successor(self.centre(self.root), j)
+        self.generation += 1 << j
+        if len(self.nodes) > self.maxNodes:
+            self.collect()
+
+    # Racine agrandie autour de la figure
+    def grow(self):
+        half = 1 << (self.root.level - 1)
+        self.root = self.centre(self.root)
+        self.x -= half
+        self.y -= half
+
+    # Avance de n générations, par sauts de 2^j générations
+    def advance(self, n):
+        j = 0
+        while n > 0:
+            if n & 1:
+                self.jump(j)
+            n >>= 1
+            j += 1
+
+    # Oubli des noeuds qui ne font plus partie de la racine, et des évolutions
+    def collect(self):
+        self.results = {}
+        self.nodes = {}
+        self.empty = [self.dead]
+        self.root = self.copy(self.root, {})
+
+    def copy(self, node, copies):
+        if node.level == 0:
+            return node
+        copied = copies.get(node)
+        if copied is None:
+            copied = self.join(self.copy(node.nw, copies), self.copy(node.ne, copies),
+                               self.copy(node.sw, copies), self.copy(node.se, copies))
+            copies[node] = copied
+        return copied
+
+    # Remplace la figure par les pixels vivants donnés par leurs coordonnées (x, y)
+    def setCells(self, cells):
+        cells = list(cells)
+        level = 3
+        if cells:
+            x0 = min([x for x, y in cells])
+            y0 = min([y for x, y in cells])
+            size = max([max(x - x0, y - y0) for x, y in cells]) + 1
+            while (1 << level) < size:
+                level += 1
+        else:
+            x0 = y0 = 0
+        self.x = x0
+        self.y = y0
+        self.root = self.build(level, [(x - x0, y - y0) for x, y in cells])
+        self.generation = 0
+
+    def build(self, level, cells):
+        if not cells:
+            return self.emptyNode(level)
+        if level == 0:
+            return self.alive
+        half = 1 << (level - 1)
+        quarters = ([], [], [], [])
+        for x, y in cells:
+            quarters[2 * (x >= half) + (y >= half)].append((x % half, y % half))
+        return self.join(*[self.build(level - 1, q) for q in quarters])
+
+    # Place une figure (tuple de chaînes, comme pour displayPict) à partir du pixel (x, y)
+    def load(self, pict, x=0, y=0):
+        self.setCells([(x + k, y + i) for k in range(len(pict)) for i in range(len(pict[k])) if pict[k][i] != " "])
+
+    # Pixels vivants, sous forme de liste de coordonnées (x, y)
+    def cells(self):
+        out = []
+        self.listCells(self.root, self.x, self.y, out)
+        return out
+
+    def listCells(self, node, x, y, out):
+        if node.population == 0:
+            return
+        if node.level == 0:
+            out.append((x, y))
+            return
+        half = 1 << (node.level - 1)
+        self.listCells(node.nw, x, y, out)
+        self.listCells(node.ne, x, y + half, out)
+        self.listCells(node.sw, x + half, y, out)
+        self.listCells(node.se, x + half, y + half, out)
+
+    def getPixel(self, x, y):
+        node = self.root
+        x -= self.x
+        y -= self.y
+        size = 1 << node.level
+        if not (0 <= x < size and 0 <= y < size):
+            return False
+        while node.level > 0 and node.population:
+            half = 1 << (node.level - 1)
+            if x < half:
+                node = node.nw if y < half else node.ne
+            else:
+                node = node.sw if y < half else node.se
+            x %= half
+            y %= half
+        return node.population == 1
+
+    def population(self):
+        return self.root.population
+
+    # Fenêtre de 8x8 pixels à partir du pixel (x, y), sous forme de bitmap pour updateDisplay
+    def window(self, x=0, y=0):
+        bitmap = bytearray(8)
+        for k in range(8):
+            for i in range(8):
+                if self.getPixel(x + k, y + i):
+                    bitmap[k] = bitmap[k] | (1 << i)
+        return bitmap
+
 def lifeStep(bitmap):
- bitmap1=bytearray(8)
- for k in range(8):
-  bitmap1[k]=bitmap[k]
- for i in range(8):
-  for j in range(8):
-   if countNeighbours(i,j,bitmap1)==3:
-    setPixel(i,j,1,bitmap)
-   elif countNeighbours(i,j,bitmap1)!=2:
-    setPixel(i,j,0,bitmap)
+ Grid(8, len(bitmap), True, bitmap).step()
  updateDisplay(bitmap)
 
-def gameOfLife(N):
+# Clé de 64 bits d'un bitmap, qui identifie une génération
+def boardKey(bitmap):
+ return int.from_bytes(bytes(bitmap), 'little')
+
+# Détection de cycle de Brent sur les clés des générations successives : la clé de la
+# génération qui commence chaque bloc de 1, 2, 4, 8... générations est gardée et comparée
+# aux suivantes, ce qui trouve la période la plus petite sans garder d'historique.
+# Les cas les plus fréquents, extinction et figures stables, sont reconnus dès qu'ils
+# apparaissent en comparant aussi chaque clé à la précédente.
+class CycleDetector:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.saved = None
+        self.previous = None
+        self.power = 1
+        self.distance = 0
+
+    # Ajout de la génération suivante, renvoie la période si les générations se répètent, sinon 0
+    def add(self, key):
+        previous = self.previous
+        self.previous = key
+        if self.saved is None:
+            self.saved = key
+            return 0
+        if key == 0 or key == previous:
+            return 1
+        self.distance += 1
+        if key == self.saved:
+            return self.distance
+        if self.distance == self.power:
+            self.saved = key
+            self.power *= 2
+            self.distance = 0
+        return 0
+
+# Classification d'un jeu qui se répète avec la période period
+EXTINCTION = 'extinction'
+STILL_LIFE = 'still life'
+PERIODIC = 'periodic'
+# Jeu qui ne s'est pas encore répété
+RUNNING = 'running'
+
+def classify(bitmap, period):
+ if period == 0:
+  return RUNNING
+ if boardKey(bitmap) == 0:
+  return EXTINCTION
+ if period == 1:
+  return STILL_LIFE
+ return PERIODIC
+
+# Jeu de la vie pendant N générations au plus, à partir d'un bitmap aléatoire
+# Le jeu s'arrête dès que les générations se répètent (extinction, figures stables ou
+# oscillantes, vaisseaux revenus à leur place sur le tore), ou recommence avec un nouveau
+# bitmap aléatoire si reseed est vrai. Renvoie la liste des (classification, période,
+# nombre de générations) de chaque jeu, la période étant 0 pour un jeu qui n'a pas fini.
+def gameOfLife(N, reseed=False):
+ results=[]
  bitmap=randomBitmap()
+ detector=CycleDetector()
+ detector.add(boardKey(bitmap))
+ generations=0
  for k in range(N):
   lifeStep(bitmap)
+  generations+=1
   pyb.delay(200)
+  period=detector.add(boardKey(bitmap))
+  if period:
+   results.append((classify(bitmap, period), period, generations))
+   if not reseed:
+    return results
+   bitmap=randomBitmap()
+   detector.reset()
+   detector.add(boardKey(bitmap))
+   generations=0
+ results.append((RUNNING, 0, generations))
+ return results
+
+# Jeu de la vie sur chips circuits MAX7219 chaînés, soit une grille de 8 x 8*chips pixels
+def gameOfLifeWide(N, chips):
+    global display
+    if display.chips != chips:
+        display = Max7219(display.spi, chips)
+    grid = Grid(8 * chips, 8)
+    for k in range(8):
+        grid.rows[k] = int.from_bytes(os.urandom(chips), 'little')
+    display.update(grid.tiles(chips))
+    for k in range(N):
+        grid.step()
+        display.update(grid.tiles(chips))
+        pyb.delay(200)
 
 # Figures stables
 stableBlock = (
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# Benchmark of the Game of Life on a PC, with the simulated pyb module (mock_pyb.py)
+# Runs gameOfLife, testGlider and testLWSS from game_of_life.py with a simulated MAX7219
+# decoding the CLK, CS and DIN signals, and gameOfLifeWide with a chain of simulated
+# MAX7219, and reports for each of them:
+#  - the generations per second (the delays of the program are not waited)
+#  - the register writes, rising edges of CS, pin toggles and SPI bytes per frame
+#    (update of the display)
+# and checks that the simulated display shows the last frame sent.
+# Results are saved as JSON, and can be compared with those of a previous run.
+
+import argparse
+import datetime
+import json
+import platform
+import sys
+import time
+
+import mock_pyb
+sys.modules['pyb'] = mock_pyb
+import game_of_life
+
+from benchmark import gitCommit
+
+cases = ['gameOfLife', 'testGlider', 'testLWSS', 'gameOfLifeWide']
+
+# Simulated MAX7219 chips connected to the pins used by the display driver
+def connectModel(chips):
+	if game_of_life.display.spi is not None:
+		sck, mosi = mock_pyb.spiPins[1]
+		return mock_pyb.Max7219Model(clk=sck, cs=game_of_life.load, din=mosi, chips=chips)
+	return mock_pyb.Max7219Model(clk=game_of_life.clk, cs=game_of_life.load, din=game_of_life.data, chips=chips)
+
+# Run a case once, returns its measures
+def runCase(name, generations, chips):
+	counts = {'generations': 0, 'frames': 0}
+	lifeStep = game_of_life.lifeStep
+	updateDisplay = game_of_life.updateDisplay
+	def countedStep(bitmap):
+		counts['generations'] += 1
+		lifeStep(bitmap)
+	def countedUpdate(bitmap):
+		counts['frames'] += 1
+		updateDisplay(bitmap)
+	game_of_life.lifeStep = countedStep
+	game_of_life.updateDisplay = countedUpdate
+	wide = name == 'gameOfLifeWide'
+	if not wide:
+		chips = 1
+	if game_of_life.display.chips != chips:
+		game_of_life.display = game_of_life.Max7219(game_of_life.display.spi, chips)
+	display = game_of_life.display
+	display.invalidate()
+	model = connectModel(chips)
+	board = mock_pyb.board
+	board.resetCounts()
+	try:
+		t0 = time.perf_counter()
+		if name == 'gameOfLife':
+			# Reseeded when the board repeats, so that all the generations are run
+			game_of_life.gameOfLife(generations, reseed=True)
+		elif wide:
+			# The grid is stepped and displayed directly
+			Grid = game_of_life.Grid
+			class CountedGrid(Grid):
+				def step(self):
+					counts['generations'] += 1
+					counts['frames'] += 1
+					Grid.step(self)
+			game_of_life.Grid = CountedGrid
+			try:
+				game_of_life.gameOfLifeWide(generations, chips)
+			finally:
+				game_of_life.Grid = Grid
+		else:
+			getattr(game_of_life, name)()
+		t = time.perf_counter() - t0
+	finally:
+		game_of_life.lifeStep = lifeStep
+		game_of_life.updateDisplay = updateDisplay
+		board.devices.remove(model)
+	frames = max(counts['frames'], 1)
+	return {
+		'name': name,
+		'chips': chips,
+		'generations': counts['generations'],
+		'frames': counts['frames'],
+		'time': t,
+		'generations_per_second': counts['generations'] / t,
+		'writes_per_frame': model.writes / frames,
+		'latches_per_frame': model.latches / frames,
+		'toggles_per_frame': board.toggles / frames,
+		'spi_bytes_per_frame': board.spiBytes / frames,
+		'display_ok': all([model.rows(chip) == display.shadow[8 * chip:8 * chip + 8] for chip in range(chips)])
+	}
+
+# Best of repeat runs of a case
+def bestRun(name, generations, chips, repeat):
+	best = None
+	for i in range(repeat):
+		result = runCase(name, generations, chips)
+		if best is None or result['time'] < best['time']:
+			best = result
+	return best
+
+def printResults(results, previous=None):
+	print('# {:14s} {:>5s} {:>6s} {:>10s} {:>8s} {:>8s} {:>8s} {:>8s} {:>7s}'.format(
+	      'case', 'chips', 'gens', 'gens/s', 'writes', 'latches', 'toggles', 'spi B', 'display')
+	      + (' {:>8s}'.format('vs prev') if previous else ''))
+	for result in results:
+		line = '  {:14s} {:5d} {:6d} {:10.1f} {:8.2f} {:8.2f} {:8.1f} {:8.1f} {:>7s}'.format(
+		       result['name'], result['chips'], result['generations'], result['generations_per_second'],
+		       result['writes_per_frame'], result['latches_per_frame'], result['toggles_per_frame'],
+		       result['spi_bytes_per_frame'], 'ok' if result['display_ok'] else 'WRONG')
+		if previous and result['name'] in previous:
+			line += ' {:7.2f}x'.format(result['generations_per_second'] / previous[result['name']]['generations_per_second'])
+		print(line)
+
+def main(argv=None):
+	argparser = argparse.ArgumentParser(description='Benchmark of the Game of Life with a simulated MAX7219')
+	argparser.add_argument('--cases', default=','.join(cases),
+	                       help='cases to run, among {} (default: %(default)s)'.format(', '.join(cases)))
+	argparser.add_argument('-n', '--generations', type=int, default=200,
+	                       help='number of generations of gameOfLife and gameOfLifeWide (default: %(default)s)')
+	argparser.add_argument('--chips', type=int, default=4,
+	                       help='number of chained MAX7219 of gameOfLifeWide (default: %(default)s)')
+	argparser.add_argument('--repeat', type=int, default=3,
+	                       help='number of runs of each case, the best time is kept (default: %(default)s)')
+	argparser.add_argument('--spi', action='store_true',
+	                       help='drive the MAX7219 with the SPI bus 1 instead of bit-banging')
+	argparser.add_argument('-o', '--output', default='life_benchmark.json',
+	                       help='JSON file of the results (default: %(default)s)')
+	argparser.add_argument('--compare', metavar='JSON',
+	                       help='results of a previous run to compare with')
+	args = argparser.parse_args(argv)
+
+	names = [name for name in args.cases.split(',') if name]
+	for name in names:
+		if name not in cases:
+			argparser.error('unknown case ' + name)
+	if args.spi:
+		game_of_life.useSPI(1)
+	results = [bestRun(name, args.generations, args.chips, args.repeat) for name in names]
+	previous = None
+	if args.compare:
+		with open(args.compare) as f:
+			previous = dict([(result['name'], result) for result in json.load(f)['results']])
+	printResults(results, previous)
+	with open(args.output, 'w') as f:
+		json.dump({
+			'commit': gitCommit(),
+			'date': datetime.datetime.now().isoformat(timespec='seconds'),
+			'python': platform.python_version(),
+			'driver': 'spi' if args.spi else 'bit-bang',
+			'repeat': args.repeat,
+			'results': results
+		}, f, indent=1)
+	print('# Results saved in ' + args.output)
+	return 0 if all([result['display_ok'] for result in results]) else 1
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,141 @@
+# Replacement of the pyb module of MicroPython for running game_of_life.py on a PC
+# Pins are simulated by name on a Board, and simulated devices (such as Max7219Model) are
+# connected to the board: they see every change of level of the pins, whether made by the
+# program with Pin.high/low/value or clocked out by SPI.send. The board counts the pin
+# operations of the program, and delays are only added up (unless realTime is set), so that
+# programs can be measured without waiting.
+
+import time
+
+class Board:
+	def __init__(self):
+		# Level of each pin by name
+		self.levels = {}
+		# Simulated devices, whose edge(board, pin, level) method is called on each change
+		self.devices = []
+		# Wait for the delays instead of only adding them up
+		self.realTime = False
+		self.resetCounts()
+
+	def resetCounts(self):
+		# Calls to Pin methods setting a level, and changes of level they made
+		self.pinWrites = 0
+		self.toggles = 0
+		# Bytes sent by SPI peripherals
+		self.spiBytes = 0
+		# Total of the delays in ms
+		self.delayed = 0
+
+	# Set the level of a pin, counted is False for the pins driven by peripherals
+	def set(self, name, level, counted=True):
+		if counted:
+			self.pinWrites += 1
+		if self.levels.get(name, 0) != level:
+			self.levels[name] = level
+			if counted:
+				self.toggles += 1
+			for device in self.devices:
+				device.edge(self, name, level)
+
+board = Board()
+
+class Pin:
+	IN = 0
+	OUT_PP = 1
+	OUT_OD = 2
+
+	def __init__(self, name, mode=IN):
+		self.name = name
+		board.levels.setdefault(name, 0)
+
+	def high(self):
+		board.set(self.name, 1)
+
+	def low(self):
+		board.set(self.name, 0)
+
+	def value(self, value=None):
+		if value is None:
+			return board.levels.get(self.name, 0)
+		board.set(self.name, 1 if value else 0)
+
+# Pins of the SPI buses of the pyboard, as (SCK, MOSI)
+spiPins = {
+	1: ('X6', 'X8'),
+	2: ('Y6', 'Y8')
+}
+
+# SPI peripheral, only as a master sending bytes, most significant bit first
+class SPI:
+	MASTER = 0
+	SLAVE = 1
+	MSB = 0
+
+	def __init__(self, bus, mode=MASTER, baudrate=328125, polarity=1, phase=0, firstbit=MSB):
+		if bus not in spiPins:
+			raise ValueError('SPI({}) does not exist'.format(bus))
+		self.sck, self.mosi = spiPins[bus]
+		self.polarity = polarity
+		board.set(self.sck, polarity, False)
+
+	def send(self, data):
+		if isinstance(data, int):
+			data = bytes([data])
+		for byte in data:
+			board.spiBytes += 1
+			for i in range(8):
+				board.set(self.mosi, (byte >> (7 - i)) & 1, False)
+				board.set(self.sck, 1 - self.polarity, False)
+				board.set(self.sck, self.polarity, False)
+
+def delay(ms):
+	board.delayed += ms
+	if board.realTime:
+		time.sleep(ms / 1000)
+
+def udelay(us):
+	delay(us / 1000)
+
+def millis():
+	return int(time.monotonic() * 1000)
+
+# Model of chips MAX7219 daisy-chained on the CLK, CS (LOAD) and DIN pins of a board
+# Bits are shifted in on the rising edges of CLK, the data out of each chip feeding the
+# next one, and the 16-bit word (address, data) held by each chip is written into its
+# register on the rising edge of CS, except for the no-op register 0. Chip 0 is the
+# one connected to the board, and receives the last word sent.
+class Max7219Model:
+	def __init__(self, clk='X1', cs='X2', din='X3', chips=1, board=board):
+		self.clk = clk
+		self.cs = cs
+		self.din = din
+		self.chips = chips
+		self.mask = (1 << (16 * chips)) - 1
+		self.shift = 0
+		# Registers of each chip, by address (1 to 8 are the rows)
+		self.registers = [bytearray(16) for chip in range(chips)]
+		self.resetCounts()
+		board.devices.append(self)
+
+	def resetCounts(self):
+		# Register writes and rising edges of CS
+		self.writes = 0
+		self.latches = 0
+
+	def edge(self, board, name, level):
+		if level == 0:
+			return
+		if name == self.clk:
+			self.shift = ((self.shift << 1) | board.levels.get(self.din, 0)) & self.mask
+		elif name == self.cs:
+			self.latches += 1
+			for chip in range(self.chips):
+				word = (self.shift >> (16 * chip)) & 0xFFFF
+				address = (word >> 8) & 0x0F
+				if address != 0:
+					self.registers[chip][address] = word & 0xFF
+					self.writes += 1
+
+	# Rows displayed by a chip, as a bitmap
+	def rows(self, chip=0):
+		return bytearray(self.registers[chip][1:9])
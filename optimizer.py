@@ -0,0 +1,415 @@
+# Peephole optimizer for mini ARM programs
+# Works on the lines produced by the parser of assembler.py, before assembly, so that
+# labels are laid out again by the assembler after the rewrite.
+#
+# The rewrites are:
+#  - add rX,rX,#0 and sub rX,rX,#0 are removed
+#  - consecutive add/sub of immediate values to the same register are folded into one
+#    (e.g. the sp adjustments of a pop followed by a push)
+#  - in mov rA,rB; mov rB,rA the second mov is removed
+#  - a ldr from the address just written by a str becomes a mov from the stored register
+#  - a str of the value just loaded from the same address is removed
+#  - branches to an unconditional branch go directly to its target (b ret -> b r7 if ret is b r7)
+#  - a b to the next instruction is removed
+# A line with a label can only be removed if its label can be moved to the next line.
+#
+# At level 2, branches and direct ldr/str are also relaxed to their 1-word register form
+# when a register is known to hold the address of their label:
+#  - in straight-line code, after mov rX,#label (until rX is written, a label or a bl)
+#  - in loops, where the address of a label used at least 3 times in the loop is loaded
+#    into a register which is not used by the program, once before the loop
+# A loop is only optimized if the code before it falls through into it, its labels are
+# not referenced from outside the loop and it does not call a subroutine.
+
+from assembler import AsmError, SourceLine, hasStructure, integerRe, isTag
+
+def lineLabel(line):
+	return line[0] if line[0][0] == '@' else None
+
+def lineInstr(line):
+	return line[-1]
+
+# New line, with the origin in the sources of the line it replaces
+def makeLine(label, instr, like=None):
+	items = [label, instr] if label else [instr]
+	origin = getattr(like, 'origin', None)
+	return SourceLine(items, origin) if origin is not None else items
+
+# Split the pseudo instruction expansions into one line per instruction
+def flatten(lines):
+	flat = []
+	for line in lines:
+		label = lineLabel(line)
+		instr = lineInstr(line)
+		if hasStructure(instr[0]):
+			for sub in instr:
+				flat.append(makeLine(label, sub, line))
+				label = None
+		else:
+			flat.append(line)
+	return flat
+
+def isReg(arg):
+	return hasStructure(arg) and arg[0] == 'r'
+
+# Value of a numeric immediate argument (#12, #-3, #0x1F), None for registers and tags
+def immValue(arg):
+	if not hasStructure(arg) or arg[0] != '#':
+		return None
+	value = arg[1]
+	if hasStructure(value):
+		return int(value[1], 16)
+	if integerRe.match(value):
+		return int(value)
+	return None
+
+def makeImm(value):
+	return ['#', str(value)]
+
+# Register only address [rY]
+def isRegAddress(arg):
+	return hasStructure(arg) and len(arg) == 1 and isReg(arg[0])
+
+# Value added to rX by an add/sub rX,rX,#imm instruction, None for other instructions
+def increment(instr):
+	if instr[0] in ('add', 'sub') and instr[1] == instr[2]:
+		value = immValue(instr[3])
+		if value is not None:
+			return value if instr[0] == 'add' else -value
+	return None
+
+def makeIncrement(reg, value):
+	if value >= 0:
+		return ['add', reg, reg, makeImm(value)]
+	return ['sub', reg, reg, makeImm(-value)]
+
+# Branch target of a b/beq/blt as a label name or register, None if it is an address
+def branchTarget(instr):
+	if instr[0] in ('b', 'beq', 'blt'):
+		target = instr[1]
+		if isReg(target) or not hasStructure(target):
+			return target
+	return None
+
+class Peephole:
+	def __init__(self, lines):
+		self.lines = flatten(lines)
+		self.rewrites = 0
+
+	# Replace n lines at index i by the instructions instrs
+	# The label of the first line is kept on the first new instruction (or moved to the
+	# line after if there is none), labels of the other lines prevent the rewrite.
+	def replace(self, i, n, instrs):
+		lines = self.lines
+		if any([lineLabel(line) for line in lines[i+1:i+n]]):
+			return False
+		label = lineLabel(lines[i])
+		new = [makeLine(None, instr, lines[i]) for instr in instrs]
+		if label:
+			if new:
+				new[0] = makeLine(label, new[0][0], lines[i])
+			elif i + n < len(lines) and not lineLabel(lines[i + n]):
+				lines[i + n] = makeLine(label, lineInstr(lines[i + n]), lines[i + n])
+			else:
+				return False
+		lines[i:i+n] = new
+		self.rewrites += 1
+		return True
+
+	# Index of the line with a label
+	def labelIndex(self, name):
+		for i, line in enumerate(self.lines):
+			label = lineLabel(line)
+			if label and label[1] == name:
+				return i
+		return None
+
+	# Try the rewrites at line i, returns True if the program was changed
+	def rewriteAt(self, i):
+		lines = self.lines
+		a = lineInstr(lines[i])
+		b = lineInstr(lines[i + 1]) if i + 1 < len(lines) else None
+		inc = increment(a)
+		# add rX,rX,#0
+		if inc == 0:
+			return self.replace(i, 1, [])
+		if b is None:
+			return False
+		# The second line can be removed if it is only reached from the first one
+		single = lineLabel(lines[i + 1]) is None
+		# add rX,rX,#a; add rX,rX,#b -> add rX,rX,#(a+b)
+		if inc is not None and increment(b) is not None and a[1] == b[1]:
+			total = inc + increment(b)
+			if -(1 << 15) <= total < (1 << 15):
+				return self.replace(i, 2, [makeIncrement(a[1], total)] if total != 0 else [])
+		# mov rA,rB; mov rB,rA
+		if single and a[0] == 'mov' and b[0] == 'mov' and isReg(a[2]) and b[1] == a[2] and b[2] == a[1]:
+			return self.replace(i + 1, 1, [])
+		# str rX,[rY]; ldr rZ,[rY] -> str rX,[rY]; mov rZ,rX
+		if single and a[0] == 'str' and b[0] == 'ldr' and isRegAddress(a[2]) and a[2] == b[2]:
+			return self.replace(i + 1, 1, [] if b[1] == a[1] else [['mov', b[1], a[1]]])
+		# ldr rA,[rY]; str rA,[rY] -> ldr rA,[rY]
+		if single and a[0] == 'ldr' and b[0] == 'str' and isRegAddress(a[2]) and a[2] == b[2] \
+		   and a[1] == b[1] and a[1] != a[2][0]:
+			return self.replace(i + 1, 1, [])
+		# b to the next instruction
+		target = branchTarget(a)
+		if a[0] == 'b' and target is not None and not isReg(target):
+			label = lineLabel(lines[i + 1])
+			if label and label[1] == target:
+				return self.replace(i, 1, [])
+		return False
+
+	# Branches to an unconditional branch go to its target
+	def threadJumps(self):
+		changed = False
+		for i, line in enumerate(self.lines):
+			instr = lineInstr(line)
+			target = branchTarget(instr)
+			hops = 0
+			while target is not None and not isReg(target) and hops < 16:
+				j = self.labelIndex(target)
+				if j is None or j == i:
+					break
+				next = branchTarget(lineInstr(self.lines[j]))
+				if next is None or lineInstr(self.lines[j])[0] != 'b' or next == target:
+					break
+				target = next
+				hops += 1
+			if hops > 0:
+				self.lines[i] = makeLine(lineLabel(line), [instr[0], target], line)
+				self.rewrites += 1
+				changed = True
+		return changed
+
+	def run(self):
+		changed = True
+		while changed:
+			changed = self.threadJumps()
+			i = 0
+			while i < len(self.lines):
+				if self.rewriteAt(i):
+					changed = True
+					i = max(i - 3, 0)   # the rewrite may enable another one just before
+				else:
+					i += 1
+		return self.lines
+
+# Registers (as ['r', 'N'] lists) appearing in the arguments of an instruction
+def usedRegisters(instr):
+	regs = []
+	for arg in instr[1:]:
+		if isReg(arg):
+			regs.append(arg)
+		elif hasStructure(arg) and arg[0] != '#':
+			regs.extend([a for a in arg if isReg(a)])
+	return regs
+
+# Register written by an instruction, None if there is none
+def writtenRegister(instr):
+	if instr[0] in ('ldr', 'mov', 'add', 'sub', 'bl'):
+		return instr[1]
+	return None
+
+# Labels referenced by an instruction
+def labelRefs(instr):
+	refs = []
+	for arg in instr[1:]:
+		if isTag(arg):
+			refs.append(arg)
+		elif hasStructure(arg) and arg[0] != 'r':
+			refs.extend([a for a in arg if isTag(a)])
+	return refs
+
+# Label of an instruction which can be relaxed to a register form, None if there is none
+def relaxableLabel(instr):
+	if instr[0] in ('b', 'beq', 'blt', 'ldr', 'str'):
+		target = instr[1] if instr[0] in ('b', 'beq', 'blt') else instr[2]
+	elif instr[0] == 'bl':
+		target = instr[2]
+	else:
+		return None
+	return target if isTag(target) else None
+
+# Register form of an instruction, reg holding the address of its label
+def relaxedInstr(instr, reg):
+	if instr[0] in ('b', 'beq', 'blt'):
+		return [instr[0], reg]
+	if instr[0] == 'bl':
+		return ['bl', instr[1], reg]
+	return [instr[0], instr[1], [reg]]
+
+class Relaxation:
+	def __init__(self, lines):
+		self.lines = flatten(lines)
+		self.relaxed = 0
+		# Index of the line of each label
+		self.labelIndex = {}
+		for i, line in enumerate(self.lines):
+			if lineLabel(line):
+				self.labelIndex[lineLabel(line)[1]] = i
+
+	# Registers which are never used by the program (sp and lr excepted)
+	def freeRegisters(self):
+		used = set()
+		for line in self.lines:
+			used.update([reg[1] for reg in usedRegisters(lineInstr(line))])
+		return [['r', str(n)] for n in range(6) if str(n) not in used]
+
+	# Loops as (first line, last line) ranges, from the innermost ones
+	# A loop starts at a label and ends with the last branch back to it (branches to
+	# themselves stop the program and are not loops)
+	def findLoops(self):
+		ends = {}
+		for j, line in enumerate(self.lines):
+			target = branchTarget(lineInstr(line))
+			if target is not None and not isReg(target) and self.labelIndex.get(target, j) < j:
+				i = self.labelIndex[target]
+				ends[i] = max(ends.get(i, j), j)
+		return sorted(ends.items(), key=lambda loop: loop[1] - loop[0])
+
+	# A loop can only be entered by falling through its first line if no label in it is
+	# referenced from outside
+	def isClosed(self, first, last):
+		if first > 0 and lineInstr(self.lines[first - 1])[0] in ('b', 'smw', 'rmw'):
+			return False
+		inside = set([lineLabel(line)[1] for line in self.lines[first:last+1] if lineLabel(line)])
+		for i, line in enumerate(self.lines):
+			if (i < first or i > last) and inside.intersection(labelRefs(lineInstr(line))):
+				return False
+		return True
+
+	# Choose the registers loaded before each loop, as (first line, last line, register, label) entries
+	# The labels used by the most instructions of the loop come first, the start of the loop first
+	# for the same number, and b or bl out of the loop are ignored (they run once per loop).
+	# Loops which overlap use different registers. Loops with a bl are left alone, as the free
+	# registers are the same for the whole program and the subroutine may load its own loops.
+	# A label is only loaded if it has at least minUses uses, each of them saving a word and a
+	# cycle, so that the mov (2 words, 3 cycles) makes the program smaller and pays for itself
+	# from the second iteration.
+	def hoist(self, minUses=3):
+		free = self.freeRegisters()
+		hoisted = []
+		for first, last in self.findLoops():
+			if not self.isClosed(first, last):
+				continue
+			if any([lineInstr(line)[0] == 'bl' for line in self.lines[first:last+1]]):
+				continue
+			uses = {}
+			for line in self.lines[first:last+1]:
+				instr = lineInstr(line)
+				label = relaxableLabel(instr)
+				if label is None or (instr[0] in ('b', 'bl') and not first <= self.labelIndex.get(label, -1) <= last):
+					continue
+				uses[label] = uses.get(label, 0) + 1
+			start = lineLabel(self.lines[first])[1]
+			for label in sorted(uses, key=lambda l: (-uses[l], l != start)):
+				if uses[label] < minUses:
+					break
+				busy = [h[2] for h in hoisted if h[0] <= last and first <= h[1]]
+				regs = [reg for reg in free if reg not in busy]
+				if not regs:
+					break
+				hoisted.append((first, last, regs[0], label))
+		return hoisted
+
+	def run(self):
+		hoisted = self.hoist()
+		# Relax the instructions, tracking the registers which hold the address of a label
+		known = {}
+		for i, line in enumerate(self.lines):
+			if lineLabel(line):
+				known = {}
+			instr = lineInstr(line)
+			label = relaxableLabel(instr)
+			if label is not None:
+				regs = [h[2] for h in hoisted if h[0] <= i <= h[1] and h[3] == label]
+				regs += [['r', n] for n, value in sorted(known.items()) if value == label]
+				if regs:
+					self.lines[i] = makeLine(lineLabel(line), relaxedInstr(instr, regs[0]), line)
+					self.relaxed += 1
+			written = writtenRegister(instr)
+			if instr[0] == 'bl':
+				known = {}
+			elif written is not None:
+				known.pop(written[1], None)
+				if instr[0] == 'mov' and instr[2][0] == '#' and isTag(instr[2][1]):
+					known[written[1]] = instr[2][1]
+		# Then load the registers before the loops
+		for first, last, reg, label in sorted(hoisted, key=lambda h: -h[0]):
+			self.lines.insert(first, makeLine(None, ['mov', reg, ['#', label]], self.lines[first]))
+		return self.lines
+
+# Optimize the lines of a program
+# Level 1 runs the peephole optimizer, level 2 also relaxes branches and addresses to registers
+def optimize(lines, level=1):
+	lines = Peephole(lines).run()
+	if level >= 2:
+		lines = Relaxation(lines).run()
+	return lines
+
+# Words of the data (smw and rmw lines) of an image, in program order
+def dataWords(image, mem):
+	words = []
+	for line, pc, size in image.code:
+		if lineInstr(line)[0] in ('smw', 'rmw'):
+			words.extend(mem[pc:pc+size])
+	return words
+
+# Whether the values of register n at the end of the original and optimized program are the same
+# Addresses of the same label are considered equal, as well as addresses in data (such as the
+# stack pointer) at the same offset from the last label before them, and any addresses of code
+# for the link register
+def sameValue(before, after, n, vbefore, vafter):
+	if vbefore == vafter:
+		return True
+	for label, address in before.labels.items():
+		if address == vbefore and after.labels.get(label) == vafter:
+			return True
+	if not isCode(before, vbefore):
+		data = [(address, label) for label, address in before.labels.items()
+		        if address <= vbefore and not isCode(before, address)]
+		if data:
+			address, label = max(data)
+			if label in after.labels and (after.labels[label] + vbefore - address) & 0xFFFF == vafter:
+				return True
+	return n == 7 and isCode(before, vbefore) and isCode(after, vafter)
+
+def isCode(image, address):
+	for line, pc, size in image.code:
+		if pc <= address < pc + size:
+			return lineInstr(line)[0] not in ('smw', 'rmw')
+	return False
+
+# Size and cycle report of the optimization of a program
+# Both versions are run in the simulator for at most maxsteps instructions, to measure their
+# cycles and check that they end with the same registers and data, raises AsmError if not
+# (registers not used by the original program are not compared)
+# Returns the report and the reason why the optimized program could not be checked, None if it was
+def optimizationReport(before, after, maxsteps=1000000):
+	from simulator import Simulator, SimulatorError
+	report = '{} -> {} words'.format(len(before.words), len(after.words))
+	sims = []
+	for image in (before, after):
+		try:
+			sim = Simulator(image.words)
+			sim.run(maxsteps)
+		except SimulatorError as e:
+			reason = 'the simulator stopped with: ' + str(e)
+			return report + ', not verified', reason
+		if not sim.halted:
+			reason = 'no halt after {} instructions'.format(maxsteps)
+			return report + ', not verified', reason
+		sims.append(sim)
+	simBefore, simAfter = sims
+	used = set()
+	for line, pc, size in before.code:
+		for instr in flatten([line]):
+			used.update([int(reg[1]) for reg in usedRegisters(lineInstr(instr))])
+	for n in sorted(used):
+		if not sameValue(before, after, n, simBefore.regs[n], simAfter.regs[n]):
+			raise AsmError('optimized program ends with r{}={:04X} instead of {:04X}'.format(
+			               n, simAfter.regs[n], simBefore.regs[n]))
+	if dataWords(before, simBefore.mem) != dataWords(after, simAfter.mem):
+		raise AsmError('optimized program ends with different data')
+	return report + ', {} -> {} cycles'.format(simBefore.cycles, simAfter.cycles), None
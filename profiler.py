@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+# Execution profiler for mini ARM programs
+# Runs a program in the simulator and reports where the instructions and cycles go:
+#  - an annotated listing, with the execution count and cycles of each line of the .lst,
+#    and the taken/not taken counts of the conditional branches
+#  - a flat profile by label (each address belongs to the last label before it)
+#  - a call graph built from bl instructions and the returns to their link address
+# In sampling mode, the program runs at full speed and the pc is only recorded every
+# interval instructions, so only the counts and cycles are (statistically) available.
+# Memory images are profiled with the labels and source lines of their .sym and .map files
+# (written by assembler.py --map) when they exist.
+
+import argparse
+import bisect
+import os
+import sys
+
+from assembler import AsmError, assemble, outputName
+from simulator import (JitSimulator, Simulator, SimulatorError, SourceMap, imageFormats, loadProgram, readMem,
+                       readSymbols, K_BEQ, K_BEQI, K_BLT, K_BLTI, K_BL, K_BLI)
+
+class Profiler:
+	# Without the assembled program, the labels may be given as (address, label) entries and
+	# the source lines as a simulator.SourceMap
+	def __init__(self, sim, image=None, symbols=None, sourceMap=None):
+		self.sim = sim
+		# Assembled program (assembler.Image), for labels and source lines
+		self.image = image
+		self.sourceMap = sourceMap
+		# Execution count and cycles by address
+		self.counts = {}
+		self.cycles = {}
+		# Taken and not taken counts of conditional branches by address
+		self.taken = {}
+		self.notTaken = {}
+		# Number of calls and inclusive cycles by (caller, callee) label
+		self.calls = {}
+		self.callCycles = {}
+		# Stack of active calls, as (return address, caller, callee, cycles at call) entries
+		self.callStack = []
+		# Sampling interval, 0 for exact profiling
+		self.interval = 0
+		if image:
+			labels = sorted([(address, label) for label, address in image.labels.items()])
+		else:
+			labels = symbols or []
+		self.labelAddresses = [address for address, label in labels]
+		self.labelNames = [label for address, label in labels]
+
+	# Label of the code containing an address
+	def labelOf(self, address):
+		i = bisect.bisect_right(self.labelAddresses, address) - 1
+		if i < 0:
+			return '{:04X}'.format(address) if not self.labelNames else '(start)'
+		return self.labelNames[i]
+
+	# Execute the program instruction by instruction, recording everything
+	def run(self, maxsteps=None):
+		sim = self.sim
+		counts = self.counts
+		cycles = self.cycles
+		steps = 0
+		while not sim.halted and (maxsteps is None or steps < maxsteps):
+			pc = sim.pc
+			before = sim.cycles
+			if sim.run(1) == 0:
+				break
+			steps += 1
+			counts[pc] = counts.get(pc, 0) + 1
+			cycles[pc] = cycles.get(pc, 0) + sim.cycles - before
+			kind, rx, ry, rz, imm, size, cost = sim.decoded[pc] or sim.decode(pc)
+			if kind in (K_BEQ, K_BEQI, K_BLT, K_BLTI):
+				if sim.pc != ((pc + size) & 0xFFFF) or sim.halted:
+					self.taken[pc] = self.taken.get(pc, 0) + 1
+				else:
+					self.notTaken[pc] = self.notTaken.get(pc, 0) + 1
+			if kind in (K_BL, K_BLI):
+				caller = self.labelOf(pc)
+				callee = self.labelOf(sim.pc)
+				self.calls[(caller, callee)] = self.calls.get((caller, callee), 0) + 1
+				self.callStack.append(((pc + size) & 0xFFFF, caller, callee, before))
+			elif self.callStack and sim.pc == self.callStack[-1][0] and sim.pc != (pc + size) & 0xFFFF:
+				# Return to the link address of the last call
+				ret, caller, callee, start = self.callStack.pop()
+				self.callCycles[(caller, callee)] = self.callCycles.get((caller, callee), 0) + sim.cycles - start
+		return steps
+
+	# Execute the program at full speed, recording the pc every interval instructions
+	# Each sample stands for interval instructions
+	def sample(self, interval, maxsteps=None):
+		sim = self.sim
+		self.interval = interval
+		steps = 0
+		while not sim.halted and (maxsteps is None or steps < maxsteps):
+			chunk = interval if maxsteps is None else min(interval, maxsteps - steps)
+			done = sim.run(chunk)
+			if done == 0:
+				break
+			steps += done
+			self.counts[sim.pc] = self.counts.get(sim.pc, 0) + done
+		# Cycles are estimated from the cycles of the sampled instructions
+		for pc, count in self.counts.items():
+			self.cycles[pc] = count * (sim.decoded[pc] or sim.decode(pc))[6]
+		return steps
+
+	def annotatedListing(self):
+		out = ['#   count   cycles  taken/not']
+		if self.image is None:
+			for pc in sorted(self.counts):
+				line = '{:9d} {:8d}  {:9s} {:04X}'.format(self.counts[pc], self.cycles[pc], self.branchCounts(pc), pc)
+				source = self.sourceMap.lookup(pc) if self.sourceMap else None
+				if source:
+					line += ' {}:{}'.format(source[0], source[1])
+				out.append(line)
+			return '\n'.join(out) + '\n'
+		for pc, lines in self.image.listingLines():
+			if pc in self.counts:
+				prefix = '{:9d} {:8d}  {:9s} '.format(self.counts[pc], self.cycles[pc], self.branchCounts(pc))
+			else:
+				prefix = ' ' * 30
+			out.append(prefix + lines[0])
+			for l in lines[1:]:
+				out.append(' ' * 30 + l)
+		return '\n'.join(out) + '\n'
+
+	def branchCounts(self, pc):
+		if pc in self.taken or pc in self.notTaken:
+			return '{}/{}'.format(self.taken.get(pc, 0), self.notTaken.get(pc, 0))
+		return ''
+
+	def flatProfile(self):
+		counts = {}
+		cycles = {}
+		for pc in self.counts:
+			label = self.labelOf(pc)
+			counts[label] = counts.get(label, 0) + self.counts[pc]
+			cycles[label] = cycles.get(label, 0) + self.cycles[pc]
+		total = max(sum(cycles.values()), 1)
+		out = ['# Flat profile{}: {} instructions, {} cycles'.format(
+		           ' (sampled every {} instructions)'.format(self.interval) if self.interval else '',
+		           sum(counts.values()), sum(cycles.values())),
+		       '#   cycles      %   instrs  label']
+		for label in sorted(cycles, key=lambda l: -cycles[l]):
+			out.append('{:10d} {:6.2f} {:8d}  {}'.format(cycles[label], 100.0 * cycles[label] / total,
+			                                             counts[label], label))
+		return '\n'.join(out) + '\n'
+
+	def callGraph(self):
+		out = ['# Call graph', '#    calls  inclusive cycles  caller -> callee']
+		for caller, callee in sorted(self.calls, key=lambda e: -self.callCycles.get(e, 0)):
+			out.append('{:10d} {:17d}  {} -> {}'.format(self.calls[(caller, callee)],
+			                                            self.callCycles.get((caller, callee), 0), caller, callee))
+		return '\n'.join(out) + '\n'
+
+def main(argv=None):
+	argparser = argparse.ArgumentParser(description='Execution profiler for mini ARM programs')
+	argparser.add_argument('program', help='assembly source file or memory image (.mem, .bin or .hex)')
+	argparser.add_argument('-n', '--max-steps', type=int, default=10000000,
+	                       help='maximum number of instructions to execute (default: %(default)s)')
+	argparser.add_argument('-s', '--sample', type=int, default=0, metavar='INTERVAL',
+	                       help='only sample the pc every INTERVAL instructions (with the JIT simulator)')
+	args = argparser.parse_args(argv)
+
+	try:
+		if os.path.splitext(args.program)[1] in imageFormats:
+			image = None
+			words = loadProgram(args.program)
+		else:
+			with open(args.program) as f:
+				text = f.read()
+			if text.startswith('v2.0 raw'):
+				image = None
+				words = readMem(text)
+			else:
+				image = assemble(text, fname=args.program)
+				words = image.words
+		symbols = None
+		sourceMap = None
+		if image is None and os.path.exists(outputName(args.program, '.sym')):
+			with open(outputName(args.program, '.sym')) as f:
+				symbols = readSymbols(f.read())
+		if image is None and os.path.exists(outputName(args.program, '.map')):
+			sourceMap = SourceMap(outputName(args.program, '.map'))
+		sim = JitSimulator(words) if args.sample > 0 else Simulator(words)
+		profiler = Profiler(sim, image, symbols, sourceMap)
+		if args.sample > 0:
+			profiler.sample(args.sample, args.max_steps)
+		else:
+			profiler.run(args.max_steps)
+	except (AsmError, SimulatorError) as e:
+		print('# Error: ' + args.program + ', ' + str(e))
+		return 1
+	sys.stdout.write(profiler.annotatedListing())
+	sys.stdout.write('\n' + profiler.flatProfile())
+	if not args.sample:
+		sys.stdout.write('\n' + profiler.callGraph())
+	if not profiler.sim.halted:
+		print('# Warning: the program did not halt after {} instructions'.format(profiler.sim.steps))
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())
@@ -0,0 +1,717 @@
+#!/usr/bin/env python3
+# Simulator for mini ARM processor
+# Executes the memory images produced by assembler.py
+#
+# Semantics of the instructions (see opcodes in assembler.py):
+#   ldr rx, [ry] / ldr rx, addr   rx <- mem[ry] / rx <- mem[addr]
+#   str rz, [ry] / str rz, addr   mem[ry] <- rz / mem[addr] <- rz
+#   mov rx, ry / mov rx, #imm     rx <- ry / rx <- imm
+#   add rx, ry, rz / add rx, ry, #imm
+#   sub rx, ry, rz / sub rx, ry, #imm
+#   cmp ry, rz / cmp ry, #imm     Z <- (ry - src == 0), N <- bit 15 of (ry - src)
+#   beq, blt, b rz / beq, blt, b addr
+#   bl rx, rz / bl rx, addr       rx <- address of the next instruction, then branch
+# In immediate mode (mode bit = 1), the immediate value or address is the second word
+# of the instruction. Indexed addressing ([ry,offset]) is not supported by the processor:
+# the offset is used as a direct address.
+# All values are 16 bit words, r6 is the stack pointer (sp) and r7 the link register (lr).
+#
+# Cycle model: each instruction costs one cycle per word fetched, plus one cycle to
+# execute, plus one cycle for the memory access of ldr and str.
+
+import argparse
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from assembler import AsmError, assemble, fieldshifts, opcodes, outputFormats, sourceMapMagic
+
+memSize = 1 << 16
+
+OP_LDR = opcodes['ldr']
+OP_STR = opcodes['str']
+OP_MOV = opcodes['mov']
+OP_ADD = opcodes['add']
+OP_SUB = opcodes['sub']
+OP_CMP = opcodes['cmp']
+OP_BEQ = opcodes['beq']
+OP_BLT = opcodes['blt']
+OP_B   = opcodes['b']
+OP_BL  = opcodes['bl']
+
+# Number of cycles of an instruction, indexed by [opcode][mode]
+cycleCounts = [[2, 3] for op in range(16)]
+cycleCounts[OP_LDR] = [3, 4]
+cycleCounts[OP_STR] = [3, 4]
+
+# Decoded instructions are specialized by opcode and mode, so that the simulation loop
+# does not test the mode: kind = 2 * opcode + mode
+K_LDR, K_LDRI = 2 * OP_LDR, 2 * OP_LDR + 1
+K_STR, K_STRI = 2 * OP_STR, 2 * OP_STR + 1
+K_MOV, K_MOVI = 2 * OP_MOV, 2 * OP_MOV + 1
+K_ADD, K_ADDI = 2 * OP_ADD, 2 * OP_ADD + 1
+K_SUB, K_SUBI = 2 * OP_SUB, 2 * OP_SUB + 1
+K_CMP, K_CMPI = 2 * OP_CMP, 2 * OP_CMP + 1
+K_BEQ, K_BEQI = 2 * OP_BEQ, 2 * OP_BEQ + 1
+K_BLT, K_BLTI = 2 * OP_BLT, 2 * OP_BLT + 1
+K_B, K_BI     = 2 * OP_B, 2 * OP_B + 1
+K_BL, K_BLI   = 2 * OP_BL, 2 * OP_BL + 1
+
+class SimulatorError(Exception):
+	pass
+
+# Decode an instruction word, the second word is the immediate value in mode 1
+# Returns (kind, rx, ry, rz, imm, size, cycles)
+def decodeInstr(word, imm):
+	op = word >> fieldshifts['opcode']
+	mode = (word >> fieldshifts['mode']) & 1
+	rx = (word >> fieldshifts['rx']) & 7
+	ry = (word >> fieldshifts['ry']) & 7
+	rz = (word >> fieldshifts['rz']) & 7
+	if mode == 0:
+		imm = 0
+	return (2 * op + mode, rx, ry, rz, imm, mode + 1, cycleCounts[op][mode])
+
+# Read a memory image in Logisim 'v2.0 raw' format (with optional run lengths, as in 4*0000)
+def readMem(text):
+	lines = text.split('\n', 1)
+	if lines[0].strip() != 'v2.0 raw':
+		raise SimulatorError('not a Logisim v2.0 raw memory image')
+	words = array('H')
+	if len(lines) == 1:
+		return words
+	for token in lines[1].split():
+		if '*' in token:
+			count, value = token.split('*')
+			words.extend([int(value, 16)] * int(count))
+		else:
+			words.append(int(token, 16))
+	return words
+
+# Read a raw binary memory image, byteorder being 'little' or 'big'
+# In the byte order of the machine, the words are a view of the file mapped in memory
+def readBinary(fname, byteorder='little'):
+	with open(fname, 'rb') as f:
+		size = os.fstat(f.fileno()).st_size
+		if size % 2 != 0:
+			raise SimulatorError('binary memory image of odd size')
+		if size == 0:
+			return array('H')
+		data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+	if byteorder == sys.byteorder:
+		return memoryview(data).cast('H')
+	words = array('H')
+	words.frombytes(data)
+	words.byteswap()
+	return words
+
+# Read a memory image in Intel HEX format (words in little endian byte order)
+def readIntelHex(text):
+	data = bytearray()
+	upper = 0
+	for lineno, line in enumerate(text.splitlines(), 1):
+		line = line.strip()
+		if not line:
+			continue
+		try:
+			record = bytes.fromhex(line[1:])
+		except ValueError:
+			record = b''
+		if not line.startswith(':') or len(record) < 5 or len(record) != record[0] + 5 or sum(record) & 0xFF:
+			raise SimulatorError('line {}: invalid Intel HEX record'.format(lineno))
+		rtype = record[3]
+		if rtype == 0:
+			address = upper + (record[1] << 8 | record[2])
+			if address + record[0] > len(data):
+				data.extend(bytes(address + record[0] - len(data)))
+			data[address:address+record[0]] = record[4:-1]
+		elif rtype == 1:
+			break
+		elif rtype == 2:   # extended segment address
+			upper = int.from_bytes(record[4:6], 'big') << 4
+		elif rtype == 4:   # extended linear address
+			upper = int.from_bytes(record[4:6], 'big') << 16
+	if len(data) % 2 != 0:
+		data.append(0)
+	if sys.byteorder == 'little':
+		return memoryview(data).cast('H')
+	words = array('H')
+	words.frombytes(data)
+	words.byteswap()
+	return words
+
+# Read a symbol table (.sym file), returns its (address, label) entries sorted by address,
+# so that the label of an address can be found with bisect
+def readSymbols(text):
+	symbols = []
+	for lineno, line in enumerate(text.splitlines(), 1):
+		fields = line.split()
+		if not fields:
+			continue
+		try:
+			if len(fields) != 2:
+				raise ValueError
+			symbols.append((int(fields[0], 16), fields[1]))
+		except ValueError:
+			raise SimulatorError('line {}: invalid symbol'.format(lineno))
+	symbols.sort()
+	return symbols
+
+# Source map (.map file, see sourceMapMagic in assembler.py), read through a memory mapping
+# of the file so that a lookup takes the same time whatever the size of the program
+class SourceMap:
+	def __init__(self, fname):
+		with open(fname, 'rb') as f:
+			size = os.fstat(f.fileno()).st_size
+			if size < 16:
+				raise SimulatorError('not a source map')
+			self.data = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ)
+		if self.data[:8] != sourceMapMagic:
+			raise SimulatorError('not a source map')
+		# Number of words of the memory image
+		self.size, nfiles = struct.unpack_from('<II', self.data, 8)
+		self.files = []
+		offset = 16 + 8 * self.size
+		for i in range(nfiles):
+			length, = struct.unpack_from('<H', self.data, offset)
+			self.files.append(self.data[offset+2:offset+2+length].decode())
+			offset += 2 + length
+
+	# Source file, line and number of words of the instruction at an address, None if unknown
+	# The number of words is 0 for the words after the first one of an instruction.
+	def lookup(self, address):
+		if not 0 <= address < self.size:
+			return None
+		lineno, findex, length = struct.unpack_from('<IHH', self.data, 16 + 8 * address)
+		if lineno == 0:
+			return None
+		return (self.files[findex], lineno, length)
+
+# Formats of memory images by file extension (see outputFormats in assembler.py)
+imageFormats = {
+	'.mem': 'logisim',
+	'.bin': 'bin-le',
+	'.hex': 'ihex'
+}
+
+# Load a program, either an assembly source (.s) or a memory image
+# The format of memory images is given by fmt or by the extension of their file.
+def loadProgram(fname, fmt=None):
+	if fmt is None:
+		fmt = imageFormats.get(os.path.splitext(fname)[1])
+	if fmt == 'bin-le' or fmt == 'bin-be':
+		return readBinary(fname, 'little' if fmt == 'bin-le' else 'big')
+	with open(fname) as f:
+		text = f.read()
+	if fmt == 'ihex':
+		return readIntelHex(text)
+	if text.startswith('v2.0 raw'):
+		return readMem(text)
+	return assemble(text, fname=fname).words
+
+class Simulator:
+	def __init__(self, words):
+		# Memory, the program is loaded at address 0
+		# Words given as an array or a memoryview (see readBinary) are copied in one go
+		self.mem = array('H')
+		if isinstance(words, (array, memoryview)):
+			self.mem.frombytes(memoryview(words).cast('B'))
+		else:
+			self.mem.extend(words)
+		if len(self.mem) > memSize:
+			raise SimulatorError('program does not fit into memory')
+		self.mem.frombytes(bytes(2 * (memSize - len(self.mem))))
+		# Decoded instructions, indexed by address
+		self.decoded = [None] * memSize
+		# Addresses of code which must be notified to codeModified when written
+		self.watched = bytearray(memSize)
+		self.reset()
+
+	def reset(self):
+		self.regs = [0] * 8
+		self.pc = 0
+		# Status register
+		self.z = False
+		self.n = False
+		self.cycles = 0
+		self.steps = 0
+		# Set when the program loops on a branch to itself (e.g. @end b end)
+		self.halted = False
+
+	@property
+	def sp(self):
+		return self.regs[6]
+
+	@property
+	def lr(self):
+		return self.regs[7]
+
+	def decode(self, pc):
+		instr = decodeInstr(self.mem[pc], self.mem[(pc + 1) & 0xFFFF])
+		if instr[0] > K_BLI:
+			raise SimulatorError('invalid instruction {:04X} at {:04X}'.format(self.mem[pc], pc))
+		self.decoded[pc] = instr
+		return instr
+
+	# Write into memory, decoded instructions using this word are invalidated
+	def store(self, address, value):
+		self.mem[address] = value
+		self.decoded[address] = None
+		self.decoded[(address - 1) & 0xFFFF] = None
+		if self.watched[address]:
+			self.codeModified(address)
+
+	# Called when a watched word of code is written
+	def codeModified(self, address):
+		pass
+
+	def step(self):
+		return self.run(1)
+
+	# Execute at most maxsteps instructions (without limit if None), or until the program halts
+	# Returns the number of executed instructions
+	def run(self, maxsteps=None):
+		if self.halted:
+			return 0
+		regs = self.regs
+		mem = self.mem
+		decoded = self.decoded
+		watched = self.watched
+		pc = self.pc
+		z = self.z
+		n = self.n
+		cycles = 0
+		steps = 0
+		limit = -1 if maxsteps is None else maxsteps
+		while steps != limit:
+			instr = decoded[pc]
+			if instr is None:
+				instr = self.decode(pc)
+			kind, rx, ry, rz, imm, size, cost = instr
+			cycles += cost
+			steps += 1
+			# Most frequent instructions first
+			if kind == K_ADDI:
+				regs[rx] = (regs[ry] + imm) & 0xFFFF
+			elif kind == K_CMPI:
+				d = (regs[ry] - imm) & 0xFFFF
+				z = d == 0
+				n = d >= 0x8000
+			elif kind == K_CMP:
+				d = (regs[ry] - regs[rz]) & 0xFFFF
+				z = d == 0
+				n = d >= 0x8000
+			elif kind == K_BI or (kind == K_BLTI and n) or (kind == K_BEQI and z):
+				if imm == pc:
+					self.halted = True
+					break
+				pc = imm
+				continue
+			elif kind == K_MOV:
+				regs[rx] = regs[ry]
+			elif kind == K_MOVI:
+				regs[rx] = imm
+			elif kind == K_ADD:
+				regs[rx] = (regs[ry] + regs[rz]) & 0xFFFF
+			elif kind == K_SUB:
+				regs[rx] = (regs[ry] - regs[rz]) & 0xFFFF
+			elif kind == K_SUBI:
+				regs[rx] = (regs[ry] - imm) & 0xFFFF
+			elif kind == K_LDR:
+				regs[rx] = mem[regs[ry]]
+			elif kind == K_LDRI:
+				regs[rx] = mem[imm]
+			elif kind == K_STR or kind == K_STRI:
+				address = regs[ry] if kind == K_STR else imm
+				mem[address] = regs[rz]
+				decoded[address] = None
+				decoded[(address - 1) & 0xFFFF] = None
+				if watched[address]:
+					self.codeModified(address)
+			elif kind == K_B or (kind == K_BLT and n) or (kind == K_BEQ and z):
+				if regs[rz] == pc:
+					self.halted = True
+					break
+				pc = regs[rz]
+				continue
+			elif kind == K_BLI or kind == K_BL:
+				target = imm if kind == K_BLI else regs[rz]
+				regs[rx] = (pc + size) & 0xFFFF
+				pc = target
+				continue
+			pc = (pc + size) & 0xFFFF
+		self.pc = pc
+		self.z = z
+		self.n = n
+		self.cycles += cycles
+		self.steps += steps
+		return steps
+
+	def state(self):
+		return 'pc={:04X} {} Z={:d} N={:d} steps={} cycles={}'.format(
+			self.pc, ' '.join(['r{}={:04X}'.format(i, r) for i, r in enumerate(self.regs)]),
+			self.z, self.n, self.steps, self.cycles)
+
+# Maximum number of instructions in a translated block
+maxBlockLength = 256
+
+# Python code for the instructions of a translated block, {x}, {y}, {z} are the register
+# numbers, {imm} the immediate value
+blockCode = {
+	K_MOV : 'r{x} = r{y}',
+	K_MOVI: 'r{x} = {imm}',
+	K_ADD : 'r{x} = (r{y} + r{z}) & 0xFFFF',
+	K_ADDI: 'r{x} = (r{y} + {imm}) & 0xFFFF',
+	K_SUB : 'r{x} = (r{y} - r{z}) & 0xFFFF',
+	K_SUBI: 'r{x} = (r{y} - {imm}) & 0xFFFF',
+	K_CMP : 'd = (r{y} - r{z}) & 0xFFFF',
+	K_CMPI: 'd = (r{y} - {imm}) & 0xFFFF',
+	K_LDR : 'r{x} = mem[r{y}]',
+	K_LDRI: 'r{x} = mem[{imm}]',
+	K_STR : 'a = r{y}',
+	K_STRI: 'a = {imm}',
+}
+
+# Simulator translating blocks of code into Python functions
+# A block starts at the target of a branch and ends with an unconditional branch (b or bl).
+# Conditional branches (beq, blt) leave the block when taken. Branches back to the start of
+# the block are translated into a loop. The function of a block keeps the registers in
+# local variables, executes at most budget instructions and returns (next pc, Z, N, number of
+# executed instructions, number of cycles), next pc being ~pc when the program halts on a
+# branch to itself.
+# Blocks are cached by entry address, and invalidated when a str writes into their code.
+class JitSimulator(Simulator):
+	def __init__(self, words):
+		Simulator.__init__(self, words)
+		# Translated blocks by entry address, as (function, number of instructions of
+		# the longest path through the block, addresses of the block) entries
+		self.blocks = {}
+		# Entry addresses of the blocks which contain an address
+		self.blocksAt = {}
+		# Global variables of the block functions
+		self.blockGlobals = {'mem': self.mem, 'decoded': self.decoded, 'watched': self.watched,
+		                     'codeModified': self.codeModified}
+
+	# Instructions of the block starting at pc, as (address, decoded instruction) entries
+	# The block ends before a word which is not an instruction (such as data after a conditional
+	# branch), so that the error is only raised if it is executed.
+	def blockInstrs(self, pc):
+		instrs = []
+		address = pc
+		while len(instrs) < maxBlockLength:
+			if instrs and decodeInstr(self.mem[address], self.mem[(address + 1) & 0xFFFF])[0] > K_BLI:
+				break
+			instr = self.decode(address)
+			instrs.append((address, instr))
+			if instr[0] in (K_B, K_BI, K_BL, K_BLI):
+				break
+			address = (address + instr[5]) & 0xFFFF
+		return instrs
+
+	# Generate the Python source of the block starting at pc
+	def blockSource(self, pc):
+		instrs = self.blockInstrs(pc)
+		last, (kind, rx, ry, rz, imm, size, cost) = instrs[-1]
+		# Branches back to the start of the block (except for a branch to itself) make a loop,
+		# each of them counts its iterations in c0, c1...
+		backEdges = []
+		if len(instrs) > 1:
+			backEdges = [address for address, instr in instrs
+			             if instr[0] in (K_BI, K_BEQI, K_BLTI) and instr[4] == pc and address != pc]
+		loop = len(backEdges) > 0
+		iterations = ' + '.join(['c{}'.format(j) for j in range(len(backEdges))])
+		written = set()
+		# Number of instructions and cycles of the completed iterations
+		loopSteps = []
+		loopCycles = []
+		count = 0
+		cycles = 0
+		for address, instr in instrs:
+			count += 1
+			cycles += instr[6]
+			if instr[0] in (K_MOV, K_MOVI, K_ADD, K_ADDI, K_SUB, K_SUBI, K_LDR, K_LDRI, K_BL, K_BLI):
+				written.add(instr[1])
+			if address in backEdges:
+				loopSteps.append('c{} * {}'.format(backEdges.index(address), count))
+				loopCycles.append('c{} * {}'.format(backEdges.index(address), cycles))
+		# The status register is kept as the result d of the last comparison
+		lines = ['def block(regs, z, n, budget):',
+		         '\tr0, r1, r2, r3, r4, r5, r6, r7 = regs',
+		         '\td = 0 if z else (0x8000 if n else 1)']
+		indent = '\t'
+		if loop:
+			# At most maxit iterations so that the budget is not exceeded
+			lines.append('\t' + ' = '.join(['c{}'.format(j) for j in range(len(backEdges))]) + ' = 0')
+			lines.append('\tmaxit = (budget - {}) // {}'.format(len(instrs), len(instrs)))
+			lines.append('\twhile True:')
+			indent = '\t\t'
+		# Write back the modified registers and return
+		def leave(nextpc, count, cycles, indent):
+			for r in sorted(written):
+				lines.append(indent + 'regs[{0}] = r{0}'.format(r))
+			steps = ' + '.join(loopSteps + [str(count)])
+			cycles = ' + '.join(loopCycles + [str(cycles)])
+			lines.append(indent + 'return {}, d == 0, d >= 0x8000, {}, {}'.format(nextpc, steps, cycles))
+		count = 0
+		cycles = 0
+		for address, (kind, rx, ry, rz, imm, size, cost) in instrs:
+			count += 1
+			cycles += cost
+			nextpc = (address + size) & 0xFFFF
+			fields = {'x': rx, 'y': ry, 'z': rz, 'imm': imm}
+			if kind in blockCode:
+				lines.append(indent + blockCode[kind].format(**fields))
+				if kind in (K_STR, K_STRI):
+					lines.append(indent + 'mem[a] = r{}'.format(rz))
+					lines.append(indent + 'decoded[a] = None; decoded[(a - 1) & 0xFFFF] = None')
+					lines.append(indent + 'if watched[a]:')
+					lines.append(indent + '\tcodeModified(a)')
+					leave(nextpc, count, cycles, indent + '\t')
+				continue
+			# Branches
+			if kind in (K_BI, K_BEQI, K_BLTI, K_BLI):
+				target = str(imm)
+			else:
+				lines.append(indent + 't = r{}'.format(rz))
+				target = 't'
+			if kind in (K_BL, K_BLI):
+				lines.append(indent + 'r{} = {}'.format(rx, nextpc))
+				leave(target, count, cycles, indent)
+				continue
+			if kind in (K_BEQ, K_BEQI):
+				lines.append(indent + 'if d == 0:')
+			elif kind in (K_BLT, K_BLTI):
+				lines.append(indent + 'if d >= 0x8000:')
+			else:
+				lines.append(indent + 'if True:')
+			if address in backEdges:
+				j = backEdges.index(address)
+				lines.append(indent + '\tc{} += 1'.format(j))
+				lines.append(indent + '\tif {} > maxit:'.format(iterations))
+				leave(pc, 0, 0, indent + '\t\t')
+				lines.append(indent + '\tcontinue')
+			elif target == 't':
+				lines.append(indent + '\tif t == {}:'.format(address))
+				leave('~t', count, cycles, indent + '\t\t')
+				leave(target, count, cycles, indent + '\t')
+			else:
+				leave('~' + target if imm == address else target, count, cycles, indent + '\t')
+		if kind not in (K_B, K_BI, K_BL, K_BLI):   # maximum length or data reached
+			leave(nextpc, count, cycles, indent)
+		return '\n'.join(lines) + '\n', len(instrs), [a & 0xFFFF for a in range(pc, last + size)]
+
+	def compileBlock(self, pc):
+		source, length, addresses = self.blockSource(pc)
+		namespace = dict(self.blockGlobals)
+		exec(compile(source, '<block {:04X}>'.format(pc), 'exec'), namespace)
+		block = (namespace['block'], length, addresses)
+		self.blocks[pc] = block
+		for a in addresses:
+			self.blocksAt.setdefault(a, []).append(pc)
+			self.watched[a] = 1
+		return block
+
+	# Invalidate the blocks which contain a modified word
+	def codeModified(self, address):
+		for pc in self.blocksAt.pop(address, []):
+			block = self.blocks.pop(pc, None)
+			if block is None:
+				continue
+			for a in block[2]:
+				if a in self.blocksAt and pc in self.blocksAt[a]:
+					self.blocksAt[a].remove(pc)
+		self.watched[address] = 0
+
+	def run(self, maxsteps=None):
+		if self.halted:
+			return 0
+		regs = self.regs
+		blocks = self.blocks
+		pc = self.pc
+		z = self.z
+		n = self.n
+		cycles = 0
+		steps = 0
+		halted = False
+		budget = 1 << 62 if maxsteps is None else maxsteps
+		while True:
+			block = blocks.get(pc)
+			if block is None:
+				block = self.compileBlock(pc)
+			if steps + block[1] > budget:
+				break
+			pc, z, n, count, cost = block[0](regs, z, n, budget - steps)
+			steps += count
+			cycles += cost
+			if pc < 0:
+				pc = ~pc
+				halted = True
+				break
+		self.pc = pc
+		self.z = z
+		self.n = n
+		self.halted = halted
+		self.cycles += cycles
+		self.steps += steps
+		if maxsteps is not None and not halted and steps < maxsteps:
+			# The remaining instructions do not make a whole block
+			steps += Simulator.run(self, maxsteps - steps)
+		return steps
+
+# Simulation of count instances of the same program with NumPy, for instance with different inputs
+# The registers (regs, shape (count, 8)), memories (mem, shape (count, memsize)), pc, flags and
+# counters of the instances are arrays which may be set before running. Instances are
+# executed in lock-step: at each step, the instances which are at the same address execute
+# this instruction together. An instance is retired when it loops on a branch to itself.
+# Instructions are decoded from the initial program, which must not modify its code.
+class BatchSimulator:
+	def __init__(self, words, count, memsize=4096):
+		import numpy as np
+		self.np = np
+		if len(words) > memsize:
+			raise SimulatorError('program does not fit into memory')
+		self.count = count
+		self.memsize = memsize
+		self.program = array('H', words)
+		self.program.frombytes(bytes(2 * (memsize - len(self.program))))
+		self.mem = np.tile(np.frombuffer(self.program, dtype=np.uint16), (count, 1))
+		self.regs = np.zeros((count, 8), dtype=np.uint16)
+		self.pc = np.zeros(count, dtype=np.int64)
+		self.z = np.zeros(count, dtype=bool)
+		self.n = np.zeros(count, dtype=bool)
+		self.cycles = np.zeros(count, dtype=np.int64)
+		self.steps = np.zeros(count, dtype=np.int64)
+		self.halted = np.zeros(count, dtype=bool)
+		# Decoded instructions, and addresses of the words which have been decoded
+		self.decoded = {}
+		self.code = np.zeros(memsize, dtype=bool)
+
+	def decode(self, pc):
+		if pc >= self.memsize:
+			raise SimulatorError('pc {:04X} outside of memory'.format(pc))
+		instr = decodeInstr(self.program[pc], self.program[(pc + 1) % self.memsize])
+		if instr[0] > K_BLI:
+			raise SimulatorError('invalid instruction {:04X} at {:04X}'.format(self.program[pc], pc))
+		# Words stored before the instruction is first executed are only seen here
+		size = instr[5]
+		if (self.mem[:, pc:pc + size] != self.np.frombuffer(self.program, dtype=self.np.uint16)[pc:pc + size]).any():
+			raise SimulatorError('code at {:04X} modified before being executed, use Simulator for self modifying programs'.format(pc))
+		self.decoded[pc] = instr
+		self.code[pc:pc + size] = True
+		return instr
+
+	def checkAddresses(self, address):
+		np = self.np
+		if np.any(address >= self.memsize):
+			raise SimulatorError('memory access outside of memory')
+
+	# Execute the instruction at address pc for the instances of index idx
+	def execute(self, pc, idx):
+		np = self.np
+		regs = self.regs
+		instr = self.decoded.get(pc)
+		if instr is None:
+			instr = self.decode(pc)
+		kind, rx, ry, rz, imm, size, cost = instr
+		self.cycles[idx] += cost
+		self.steps[idx] += 1
+		nextpc = pc + size
+		if kind == K_MOVI:
+			regs[idx, rx] = imm
+		elif kind == K_MOV:
+			regs[idx, rx] = regs[idx, ry]
+		elif kind == K_ADDI:
+			regs[idx, rx] = regs[idx, ry] + np.uint16(imm)
+		elif kind == K_ADD:
+			regs[idx, rx] = regs[idx, ry] + regs[idx, rz]
+		elif kind == K_SUBI:
+			regs[idx, rx] = regs[idx, ry] - np.uint16(imm)
+		elif kind == K_SUB:
+			regs[idx, rx] = regs[idx, ry] - regs[idx, rz]
+		elif kind == K_CMPI or kind == K_CMP:
+			src = np.uint16(imm) if kind == K_CMPI else regs[idx, rz]
+			d = regs[idx, ry] - src
+			self.z[idx] = d == 0
+			self.n[idx] = d >= 0x8000
+		elif kind == K_LDR or kind == K_LDRI:
+			rows = np.arange(self.count)[idx]
+			address = regs[idx, ry].astype(np.int64) if kind == K_LDR else imm
+			self.checkAddresses(address)
+			regs[idx, rx] = self.mem[rows, address]
+		elif kind == K_STR or kind == K_STRI:
+			rows = np.arange(self.count)[idx]
+			address = regs[idx, ry].astype(np.int64) if kind == K_STR else imm
+			self.checkAddresses(address)
+			if np.any(self.code[address]):
+				raise SimulatorError('store into the code at {:04X}, use Simulator for self modifying programs'.format(pc))
+			self.mem[rows, address] = regs[idx, rz]
+		elif kind == K_BL or kind == K_BLI:
+			target = regs[idx, rz].astype(np.int64) if kind == K_BL else imm
+			regs[idx, rx] = nextpc
+			self.pc[idx] = target
+			return
+		else:   # branches
+			if kind == K_B or kind == K_BI:
+				taken = True
+			elif kind == K_BEQ or kind == K_BEQI:
+				taken = self.z[idx]
+			else:
+				taken = self.n[idx]
+			target = regs[idx, rz].astype(np.int64) if kind in (K_B, K_BEQ, K_BLT) else imm
+			self.halted[idx] = taken & (target == pc)
+			self.pc[idx] = np.where(taken, target, nextpc)
+			return
+		self.pc[idx] = nextpc
+
+	# Execute at most maxsteps lock-steps (without limit if None), or until all instances halt
+	# Returns the number of lock-steps
+	def run(self, maxsteps=None):
+		np = self.np
+		count = 0
+		while maxsteps is None or count < maxsteps:
+			active = ~self.halted
+			if not active.any():
+				break
+			pcs = np.unique(self.pc[active])
+			if len(pcs) == 1 and active.all():
+				# All instances at the same address, no need for index arrays
+				self.execute(int(pcs[0]), slice(None))
+			else:
+				# The groups are taken before executing any of them, so that an instance which
+				# moves to an address executed later in this step waits for the next one
+				groups = [(int(pc), np.nonzero(active & (self.pc == pc))[0]) for pc in pcs]
+				for pc, idx in groups:
+					self.execute(pc, idx)
+			count += 1
+		return count
+
+def main(argv=None):
+	argparser = argparse.ArgumentParser(description='Simulator for mini ARM processor')
+	argparser.add_argument('program', help='assembly source file or memory image (.mem, .bin or .hex)')
+	argparser.add_argument('-f', '--format', choices=sorted(outputFormats),
+	                       help='format of the memory image (default: given by the extension of its file)')
+	argparser.add_argument('-n', '--max-steps', type=int, default=10000000,
+	                       help='maximum number of instructions to execute (default: %(default)s)')
+	argparser.add_argument('--jit', action='store_true',
+	                       help='translate basic blocks into Python functions')
+	args = argparser.parse_args(argv)
+
+	try:
+		if args.jit:
+			sim = JitSimulator(loadProgram(args.program, args.format))
+		else:
+			sim = Simulator(loadProgram(args.program, args.format))
+		sim.run(args.max_steps)
+	except (AsmError, SimulatorError) as e:
+		print('# Error: ' + args.program + ', ' + str(e))
+		return 1
+	print(sim.state())
+	if not sim.halted:
+		print('# Warning: the program did not halt after {} instructions'.format(sim.steps))
+		return 2
+	return 0
+
+if __name__ == '__main__':
+	sys.exit(main())